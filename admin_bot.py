@@ -1,18 +1,33 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
 import psycopg2
-from psycopg2 import pool
+from psycopg2 import errors, extensions, pool
+from psycopg2.extras import execute_values
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity
+from telegram.error import BadRequest, Conflict
 from telegram.ext import (
     Updater,
     CommandHandler,
     MessageHandler,
-    Filters,
+    MessageFilter,
     CallbackQueryHandler,
     ConversationHandler,
     CallbackContext,
+    PicklePersistence,
 )
+from telegram.ext.utils.promise import Promise
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -26,8 +41,21 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 # Токен для админского бота
 ADMIN_BOT_TOKEN = os.getenv("ADMIN_BOT_TOKEN")
 
+# Публичный адрес для вебхука (например, https://admin-bot.up.railway.app).
+# Если не задан, бот получает обновления длинным опросом.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+
+# Адрес локального Bot API сервера (например, http://127.0.0.1:8081).
+# Если не задан, запросы идут напрямую в api.telegram.org.
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Файл для сохранения состояния диалогов между перезапусками.
+# Если не задан, состояние хранится только в памяти.
+PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE")
+
 # Список ID администраторов
-ADMIN_IDS = [int(id) for id in os.getenv("ADMIN_IDS", "").split(",") if id]
+ADMIN_IDS = frozenset(int(id) for id in os.getenv("ADMIN_IDS", "").split(",") if id)
 
 # Определяем состояния диалога
 (MAIN_MENU, MANAGE_USERS, MANAGE_QUESTIONS, MANAGE_PROMPTS, 
@@ -35,446 +63,858 @@ ADMIN_IDS = [int(id) for id in os.getenv("ADMIN_IDS", "").split(",") if id]
  ADD_BUSINESS_TYPE, ADD_QUESTION_FOR_TYPE, EDIT_QUESTION, EDIT_PROMPT,
  EDIT_USER_INFO, ADD_USERNAME, ADD_COMMENT) = range(15)  # Добавили 3 новых состояния
 
-# Настройка логирования
+class StaticKeyboardMarkup(InlineKeyboardMarkup):
+    """Клавиатура, которая не меняется после создания: JSON для Telegram собирается один раз."""
+
+    __slots__ = ("_json",)
+
+    def to_json(self) -> str:
+        try:
+            return self._json
+        except AttributeError:
+            self._json = super().to_json()
+            return self._json
+
+# Статические клавиатуры строятся один раз при импорте и переиспользуются во всех обработчиках
+_MAIN_MENU_MARKUP = StaticKeyboardMarkup([
+    [InlineKeyboardButton("👥 Управление пользователями", callback_data="manage_users")],
+    [InlineKeyboardButton("❓ Управление вопросами", callback_data="manage_questions")],
+    [InlineKeyboardButton("📝 Управление промптами", callback_data="manage_prompts")],
+    [InlineKeyboardButton("❌ Выход", callback_data="exit")]
+])
+_USER_MGMT_MARKUP = StaticKeyboardMarkup([
+    [InlineKeyboardButton("➕ Добавить пользователя", callback_data="add_user")],
+    [InlineKeyboardButton("➖ Удалить пользователя", callback_data="remove_user")],
+    [InlineKeyboardButton("📋 Список пользователей", callback_data="list_users")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+])
+_BACK_TO_USER_MGMT_MARKUP = StaticKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_management")]])
+_BACK_TO_QUESTION_TYPE_MARKUP = StaticKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="back_to_question_type")]])
+_BACK_TO_PROMPT_MGMT_MARKUP = StaticKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="back_to_prompt_management")]])
+_BACK_TO_USER_LIST_MARKUP = StaticKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_list")]])
+_RETURN_TO_USER_LIST_MARKUP = StaticKeyboardMarkup([[InlineKeyboardButton("🔙 Назад к списку пользователей", callback_data="back_to_user_list")]])
+_USER_LIST_MARKUP = StaticKeyboardMarkup([
+    [InlineKeyboardButton("✏️ Добавить/изменить имя или комментарий", callback_data="select_user_to_edit")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_management")]
+])
+_QUESTION_ACTIONS_MARKUP = StaticKeyboardMarkup([
+    [InlineKeyboardButton("➕ Добавить вопрос", callback_data="add_question")],
+    [InlineKeyboardButton("✏️ Редактировать вопрос", callback_data="edit_question")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_question_management")]
+])
+_USER_CARD_MARKUP = StaticKeyboardMarkup([
+    [InlineKeyboardButton("✏️ Изменить имя", callback_data="edit_username")],
+    [InlineKeyboardButton("📝 Изменить комментарий", callback_data="edit_comment")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_select")]
+])
+_CANCEL_EDIT_MARKUP = StaticKeyboardMarkup([[InlineKeyboardButton("🔙 Отмена", callback_data="cancel_edit")]])
+_PROMPT_VIEW_MARKUP = StaticKeyboardMarkup([
+    [InlineKeyboardButton("✏️ Редактировать промпт", callback_data="edit_prompt")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_prompt_management")]
+])
+_NEW_TYPE_ADDED_MARKUP = StaticKeyboardMarkup([
+    [InlineKeyboardButton("➕ Добавить пользователя", callback_data="add_user_for_new_type")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_management")]
+])
+# Клавиатуры для случая, когда еще нет ни одного типа бизнеса
+_NO_TYPES_FROM_USERS_MARKUP = StaticKeyboardMarkup([
+    [InlineKeyboardButton("➕ Добавить тип бизнеса", callback_data="add_business_type")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_management")]
+])
+_NO_TYPES_FROM_MAIN_MARKUP = StaticKeyboardMarkup([
+    [InlineKeyboardButton("➕ Добавить тип бизнеса", callback_data="add_business_type")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+])
+
+# Шаблон выбора типа бизнеса компилируется один раз
+_SELECT_TYPE_PATTERN = re.compile(r"^select_type:(.+)$", re.ASCII)
+
+# Настройка логирования: общий уровень (в том числе для библиотек) задает LOG_LEVEL,
+# уровень сообщений самого бота — ADMIN_BOT_LOG_LEVEL. По умолчанию оба INFO, как и
+# раньше: журнал действий администраторов пишется без дополнительной настройки.
+# Обработчики только кладут записи в очередь, вывод выполняет отдельный поток.
+_log_queue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# Сообщение подставляется в очереди, полный формат применяет поток вывода
+_log_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+_log_listener.start()
+# Дописываем оставшиеся записи при завершении процесса
+atexit.register(_log_listener.stop)
 logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    handlers=[_log_queue_handler],
+    level=os.getenv("LOG_LEVEL", "INFO").upper()
 )
 logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv("ADMIN_BOT_LOG_LEVEL", "INFO").upper())
 
-# Пул соединений для базы данных
-db_pool = psycopg2.pool.SimpleConnectionPool(
-    1, 20,  # Минимальное и максимальное количество соединений
-    host=DB_HOST,
-    database=DB_NAME,
-    user=DB_USER,
-    password=DB_PASSWORD
-)
+# Частые параметризованные запросы. Сервер разбирает и планирует каждый из них
+# один раз на соединение (PREPARE), дальше выполняется только EXECUTE.
+PREPARED_STATEMENTS = {
+    "business_types": """
+        PREPARE business_types AS
+        SELECT name FROM business_types ORDER BY name
+    """,
+    "questions_by_type": """
+        PREPARE questions_by_type(text) AS
+        SELECT id, question_text, question_order FROM questions
+        WHERE business_type = $1 ORDER BY question_order
+    """,
+    "all_prompts": """
+        PREPARE all_prompts AS
+        SELECT business_type, prompt_text FROM prompts
+    """,
+    "upsert_prompt": """
+        PREPARE upsert_prompt(text, text) AS
+        INSERT INTO prompts (business_type, prompt_text) VALUES ($1, $2)
+        ON CONFLICT (business_type) DO UPDATE SET prompt_text = EXCLUDED.prompt_text
+        RETURNING business_type
+    """,
+    "user_info": """
+        PREPARE user_info(bigint) AS
+        SELECT business_type, username, comment FROM users WHERE telegram_id = $1
+    """,
+    "upsert_user": """
+        PREPARE upsert_user(bigint, text, text, text) AS
+        INSERT INTO users (telegram_id, business_type, username, comment)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (telegram_id) DO UPDATE
+        SET business_type = EXCLUDED.business_type,
+            username = COALESCE(EXCLUDED.username, users.username),
+            comment = COALESCE(EXCLUDED.comment, users.comment)
+        RETURNING (xmax = 0) AS inserted
+    """,
+    # None в параметре оставляет поле без изменений
+    "update_user_info": """
+        PREPARE update_user_info(bigint, text, text) AS
+        UPDATE users
+        SET username = COALESCE($2, username),
+            comment = COALESCE($3, comment)
+        WHERE telegram_id = $1
+        RETURNING telegram_id
+    """,
+    "delete_user": """
+        PREPARE delete_user(bigint) AS
+        DELETE FROM users WHERE telegram_id = $1 RETURNING telegram_id
+    """,
+    # Тип, стандартные вопросы и промпт создаются одной командой. Повторный вызов
+    # ничего не меняет: конфликтующие вопросы и уже заданный промпт пропускаются.
+    "create_business_type": """
+        PREPARE create_business_type(text, text[], text) AS
+        WITH new_type AS (
+            INSERT INTO business_types (name) VALUES ($1)
+            ON CONFLICT DO NOTHING
+        ), new_questions AS (
+            INSERT INTO questions (business_type, question_text, question_order)
+            SELECT $1, q.question_text, q.question_order - 1
+            FROM unnest($2) WITH ORDINALITY AS q(question_text, question_order)
+            ON CONFLICT DO NOTHING
+        )
+        INSERT INTO prompts (business_type, prompt_text) VALUES ($1, $3)
+        ON CONFLICT (business_type) DO NOTHING
+    """,
+    "insert_question": """
+        PREPARE insert_question(text, text) AS
+        INSERT INTO questions (business_type, question_text, question_order)
+        VALUES ($1, $2, (SELECT COALESCE(MAX(question_order) + 1, 0) FROM questions WHERE business_type = $1))
+    """,
+}
+
+class PreparingConnection(extensions.connection):
+    """Соединение, запоминающее, какие запросы уже подготовлены на сервере."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+        # Момент последнего возврата в пул: по нему решается, нужна ли проверка связи
+        self.last_used = time.monotonic()
+
+# Ограничения на стороне сервера: зависший запрос или забытая транзакция
+# не держат поток обработчика и слот пула бесконечно
+DB_STATEMENT_TIMEOUT_MS = 5000
+DB_IDLE_IN_TRANSACTION_TIMEOUT_MS = 10000
+# Соединение, простоявшее в пуле дольше этого времени, перед выдачей проверяется
+# запросом SELECT 1: его могли закрыть сервер или сеть. Недавно использованные
+# соединения выдаются без лишнего обращения к базе, а разорванное во время запроса
+# соединение пул сам отбрасывает при возврате.
+DB_IDLE_CHECK_SECONDS = 60
+
+# Размер пула соединений. Каждый поток диспетчера держит не больше одного соединения,
+# а ThreadedConnectionPool не ждет освобождения, а бросает PoolError, поэтому
+# число потоков обработчиков не превышает maxconn.
+# Размер задается DB_POOL_MAX с учетом max_connections сервера и других клиентов базы.
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# Открываются сразу при запуске, первые запросы не ждут подключения
+DB_POOL_MIN = min(int(os.getenv("DB_POOL_MIN", "2")), DB_POOL_MAX)
+# Потоков обработчиков не больше, чем соединений в пуле
+BOT_WORKERS = min(int(os.getenv("BOT_WORKERS", str(DB_POOL_MAX))), DB_POOL_MAX)
+
+# Пул соединений для базы данных (потокобезопасный: обработчики PTB работают в нескольких потоках).
+# Создается при первом обращении: импорт модуля не падает, если база еще недоступна,
+# а неудачная попытка повторяется при следующем запросе.
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Возвращает пул соединений, создавая его при первом вызове."""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = pool.ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX,
+                    host=DB_HOST,
+                    database=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    connection_factory=PreparingConnection,
+                    application_name="admin_bot",
+                    options=(
+                        f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS} "
+                        f"-c idle_in_transaction_session_timeout={DB_IDLE_IN_TRANSACTION_TIMEOUT_MS}"
+                    )
+                )
+                # Закрываем соединения при любом штатном завершении процесса, а не только из main()
+                atexit.register(_db_pool.closeall)
+    return _db_pool
 
-def get_connection():
-    """Возвращает соединение из пула."""
+def get_connection(autocommit=False):
+    """Возвращает живое соединение из пула, заменяя разорванное сервером."""
     try:
+        db_pool = get_db_pool()
         conn = db_pool.getconn()
-        logger.info("Соединение с базой данных успешно получено из пула")
+        try:
+            # Пул откатывает транзакцию при возврате соединения, поэтому режим можно переключать
+            conn.autocommit = autocommit
+            # Легкая проверка только после долгого простоя: соединение могло быть закрыто
+            if time.monotonic() - conn.last_used > DB_IDLE_CHECK_SECONDS:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+        except psycopg2.Error:
+            logger.warning("Соединение из пула неактивно, открываем новое")
+            db_pool.putconn(conn, close=True)
+            conn = db_pool.getconn()
+            conn.autocommit = autocommit
+        logger.debug("Соединение с базой данных успешно получено из пула")
         return conn
     except Exception as e:
-        logger.error(f"Ошибка при получении соединения из пула: {e}")
+        logger.error("Ошибка при получении соединения из пула: %s", e)
         raise
 
-def init_database():
-    """Инициализирует базу данных, добавляя необходимые колонки."""
-    conn = get_connection()
-    cur = conn.cursor()
+def release_connection(conn):
+    """Возвращает соединение в пул."""
     try:
-        # Добавляем новые колонки в таблицу users
-        cur.execute("""
-        ALTER TABLE users 
-        ADD COLUMN IF NOT EXISTS username TEXT,
-        ADD COLUMN IF NOT EXISTS comment TEXT;
-        """)
-        conn.commit()
-        logger.info("База данных успешно обновлена.")
+        conn.last_used = time.monotonic()
+        get_db_pool().putconn(conn)
+        logger.debug("Соединение возвращено в пул")
     except Exception as e:
-        logger.error(f"Ошибка при обновлении базы данных: {e}")
-        conn.rollback()
+        logger.error("Ошибка при возвращении соединения в пул: %s", e)
+
+@contextmanager
+def pooled_conn(autocommit=False):
+    """
+    Выдает соединение из пула и гарантированно возвращает его обратно.
+    Для запросов только на чтение передается autocommit=True: без явной транзакции
+    одиночный SELECT не требует лишних BEGIN/ROLLBACK.
+    """
+    conn = get_connection(autocommit)
+    try:
+        yield conn
     finally:
-        cur.close()
         release_connection(conn)
 
-def release_connection(conn):
-    """Возвращает соединение в пул."""
-    try:
-        db_pool.putconn(conn)
-        logger.info("Соединение возвращено в пул")
-    except Exception as e:
-        logger.error(f"Ошибка при возвращении соединения в пул: {e}")
+@contextmanager
+def db_cursor(commit=False):
+    """
+    Выдает курсор на соединении из пула.
+    С commit=True блок выполняется в транзакции: она фиксируется при успехе и
+    откатывается при исключении. Без commit соединение работает в autocommit
+    и подходит для запросов только на чтение.
+    """
+    with pooled_conn(autocommit=not commit) as conn:
+        try:
+            with conn.cursor() as cur:
+                yield cur
+            if commit:
+                conn.commit()
+        except Exception:
+            if commit:
+                conn.rollback()
+            raise
+
+# Миграции схемы, применяемые при запуске (каждая идемпотентна)
+SCHEMA_MIGRATIONS = (
+    # Новые колонки в таблице users
+    """
+    ALTER TABLE users 
+    ADD COLUMN IF NOT EXISTS username TEXT,
+    ADD COLUMN IF NOT EXISTS comment TEXT;
+    """,
+    # Индекс под выборки пользователей по типу бизнеса. Индекс вопросов
+    # создает ensure_questions_order_index().
+    "CREATE INDEX IF NOT EXISTS users_business_type_idx ON users (business_type);",
+    # Справочник типов бизнеса: тип существует независимо от наличия пользователей
+    "CREATE TABLE IF NOT EXISTS business_types (name TEXT PRIMARY KEY);",
+    # Различные типы из users и questions собираются «прыжками» по индексу
+    # (loose index scan): по одному поиску на тип вместо чтения каждой строки
+    """
+    WITH RECURSIVE user_types AS (
+        SELECT MIN(business_type) AS bt FROM users
+        UNION ALL
+        SELECT (SELECT MIN(business_type) FROM users WHERE business_type > t.bt)
+        FROM user_types t WHERE t.bt IS NOT NULL
+    ), question_types AS (
+        SELECT MIN(business_type) AS bt FROM questions
+        UNION ALL
+        SELECT (SELECT MIN(business_type) FROM questions WHERE business_type > t.bt)
+        FROM question_types t WHERE t.bt IS NOT NULL
+    )
+    INSERT INTO business_types (name)
+    SELECT bt FROM user_types WHERE bt IS NOT NULL
+    UNION SELECT bt FROM question_types WHERE bt IS NOT NULL
+    UNION SELECT business_type FROM prompts
+    ON CONFLICT DO NOTHING;
+    """,
+)
+
+def execute_prepared(cur, name, params=()):
+    """Выполняет подготовленный запрос, подготавливая его при первом использовании на соединении."""
+    conn = cur.connection
+    if name not in conn.prepared_statements:
+        # PREPARE не откатывается вместе с транзакцией, поэтому запоминаем его сразу
+        cur.execute(PREPARED_STATEMENTS[name])
+        conn.prepared_statements.add(name)
+    if params:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
+
+def ensure_questions_order_index(conn):
+    """
+    Создает уникальный индекс questions (business_type, question_order). Составной индекс
+    отдает вопросы сразу в порядке question_order, а на его уникальности держатся
+    ON CONFLICT в create_business_type и нумерация в insert_question.
+    Дубли, оставленные прежним повторным добавлением типа, убираются только перед
+    первым построением индекса. Ошибка не подавляется: без индекса вопросы снова
+    начнут дублироваться, поэтому запуск прерывается.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL statement_timeout = 0")
+        cur.execute("SELECT 1 FROM pg_indexes WHERE indexname = 'questions_bt_order_uniq'")
+        if cur.fetchone() is None:
+            # Точные копии вопроса удаляются, остается самая ранняя
+            cur.execute("""
+                DELETE FROM questions q
+                USING questions d
+                WHERE q.business_type = d.business_type
+                  AND q.question_order = d.question_order
+                  AND q.question_text = d.question_text
+                  AND q.id > d.id
+                RETURNING q.id
+            """)
+            if cur.rowcount:
+                logger.warning(
+                    "Удалено повторяющихся вопросов: %s (ID: %s)",
+                    cur.rowcount, ", ".join(str(row[0]) for row in cur)
+                )
+            # Разные вопросы с одинаковым порядком сохраняются: их тип перенумеровывается
+            cur.execute("""
+                WITH renumbered AS (
+                    SELECT id, ROW_NUMBER() OVER (PARTITION BY business_type ORDER BY question_order, id) - 1 AS new_order
+                    FROM questions
+                    WHERE business_type IN (
+                        SELECT business_type FROM questions
+                        GROUP BY business_type, question_order
+                        HAVING COUNT(*) > 1
+                    )
+                )
+                UPDATE questions q
+                SET question_order = r.new_order
+                FROM renumbered r
+                WHERE q.id = r.id AND q.question_order <> r.new_order
+            """)
+            if cur.rowcount:
+                logger.warning("Перенумеровано вопросов с совпадающим порядком: %s", cur.rowcount)
+            cur.execute("""
+                CREATE UNIQUE INDEX questions_bt_order_uniq
+                ON questions (business_type, question_order) INCLUDE (id, question_text)
+            """)
+            logger.info("Создан уникальный индекс порядка вопросов")
+        # Прежний неуникальный индекс дублирует уникальный
+        cur.execute("DROP INDEX IF EXISTS questions_bt_order_idx")
+    conn.commit()
+
+def init_database():
+    """Инициализирует базу данных, применяя миграции схемы."""
+    failed = 0
+    with pooled_conn() as conn, conn.cursor() as cur:
+        # Каждая миграция в своей транзакции: сбой одной не отменяет остальные
+        for migration in SCHEMA_MIGRATIONS:
+            try:
+                # Построение индексов на больших таблицах может идти дольше statement_timeout
+                cur.execute("SET LOCAL statement_timeout = 0")
+                cur.execute(migration)
+                conn.commit()
+            except Exception as e:
+                logger.error("Ошибка при обновлении базы данных: %s", e)
+                conn.rollback()
+                failed += 1
+        try:
+            ensure_questions_order_index(conn)
+        except Exception as e:
+            logger.error("Не удалось создать уникальный индекс вопросов: %s", e)
+            conn.rollback()
+            raise
+    if not failed:
+        logger.info("База данных успешно обновлена.")
+
+# Кэш редко меняющихся данных, которые читаются почти при каждом переходе по меню.
+# Записи сбрасываются при изменениях через бота; изменения в обход бота
+# становятся видны не позже чем через TTL, что для админки приемлемо.
+_cache_lock = threading.Lock()
+_types_cache = TTLCache(maxsize=1, ttl=30)
+# Промпты всех типов загружаются одним запросом: таблица маленькая,
+# а просмотр промптов разных типов подряд не обращается к базе
+_prompts_cache = TTLCache(maxsize=1, ttl=60)
+# Списки вопросов по типу бизнеса: их читает каждый переход в меню вопросов
+_questions_cache = TTLCache(maxsize=128, ttl=60)
+# Фоновое обновление кэшей чаще самого короткого TTL: обработчики всегда читают из памяти
+CACHE_REFRESH_INTERVAL = 25
+
+def invalidate_business_types_cache():
+    """Сбрасывает кэш списка типов бизнеса."""
+    with _cache_lock:
+        _types_cache.clear()
+
+def invalidate_questions_cache(business_type):
+    """Сбрасывает кэшированный список вопросов для указанного типа бизнеса."""
+    with _cache_lock:
+        _questions_cache.pop(business_type, None)
+
+def invalidate_prompts_cache():
+    """Сбрасывает кэш промптов."""
+    with _cache_lock:
+        _prompts_cache.clear()
+
+def log_db_error(e, message, *args):
+    """
+    Логирует ошибку запроса. Отмену по statement_timeout пишет как предупреждение:
+    это перегрузка или медленный запрос, а не сбой логики.
+    """
+    level = logging.WARNING if isinstance(e, errors.QueryCanceled) else logging.ERROR
+    logger.log(level, message, *args, e)
 
 # --- Проверка администратора ---
 def is_admin(user_id):
     """Проверяет, является ли пользователь администратором."""
-    logger.info(f"Проверка прав администратора для user_id: {user_id}")
+    logger.debug("Проверка прав администратора для user_id: %s", user_id)
     return user_id in ADMIN_IDS
 
 # --- Функции для работы с базой данных ---
-def get_business_types():
-    """Получает список всех типов бизнеса из базы данных."""
-    conn = get_connection()
-    cur = conn.cursor()
+
+# Вопросы и промпт, с которыми создается новый тип бизнеса
+STANDARD_QUESTIONS = (
+    "Что именно вас приятно удивило или впечатлило при посещении?",
+    "Какие качества персонала вызвали у вас доверие и помогли почувствовать себя комфортно?",
+    "Как изменилось ваше состояние или решилась проблема после обращения?",
+    "Почему бы вы порекомендовали нас друзьям или родственникам?"
+)
+# Промпт по умолчанию, если для типа бизнеса он не задан
+DEFAULT_PROMPT = "На основе следующих ответов составь отзыв:\n\n{}\n\nСоставь связный, теплый отзыв, будто писал клиент, который остался доволен сервисом."
+def get_business_types(refresh=False):
+    """Получает список всех типов бизнеса (из кэша или, при refresh=True, из базы данных)."""
+    if not refresh:
+        with _cache_lock:
+            types = _types_cache.get("all")
+        if types is not None:
+            return types
     try:
-        cur.execute("SELECT DISTINCT business_type FROM users")
-        types = [row[0] for row in cur.fetchall()]
-        logger.info(f"Получено {len(types)} типов бизнеса")
-        return types
+        with db_cursor() as cur:
+            execute_prepared(cur, "business_types")
+            types = list(map(itemgetter(0), cur))
     except Exception as e:
-        logger.error(f"Ошибка при получении типов бизнеса: {e}")
+        log_db_error(e, "Ошибка при получении типов бизнеса: %s")
         return []
-    finally:
-        cur.close()
-        release_connection(conn)
+    logger.debug("Получено %s типов бизнеса", len(types))
+    with _cache_lock:
+        _types_cache["all"] = types
+    return types
 
-def get_users_by_business_type(business_type):
-    """Получает список пользователей для указанного типа бизнеса."""
-    conn = get_connection()
-    cur = conn.cursor()
+def get_users_page(offset, limit):
+    """
+    Получает одну страницу пользователей, сгруппированных по типу бизнеса.
+    Возвращает ({тип бизнеса: (число пользователей, [(id, имя, комментарий), ...])}, всего пользователей).
+    """
     try:
-        cur.execute(
-            """
-            SELECT telegram_id, username, comment 
-            FROM users 
-            WHERE business_type = %s
-            """, 
-            (business_type,)
-        )
-        users = [(row[0], row[1], row[2]) for row in cur.fetchall()]
-        logger.info(f"Получено {len(users)} пользователей для типа бизнеса '{business_type}'")
-        return users
+        with db_cursor() as cur:
+            # Оконные функции считаются до LIMIT, поэтому числа по типу и общее — по всей таблице
+            cur.execute(
+                """
+                SELECT business_type, COUNT(*) OVER (PARTITION BY business_type),
+                       telegram_id, username, comment, COUNT(*) OVER ()
+                FROM users 
+                ORDER BY business_type, telegram_id
+                LIMIT %s OFFSET %s
+                """,
+                (limit, offset)
+            )
+            rows = cur.fetchall()
     except Exception as e:
-        logger.error(f"Ошибка при получении пользователей для типа бизнеса '{business_type}': {e}")
-        return []
-    finally:
-        cur.close()
-        release_connection(conn)
+        log_db_error(e, "Ошибка при получении списка пользователей: %s")
+        return {}, 0
+    grouped = {}
+    for (btype, count), type_rows in groupby(rows, key=itemgetter(0, 1)):
+        grouped[btype] = (count, list(map(itemgetter(2, 3, 4), type_rows)))
+    total = rows[0][5] if rows else 0
+    logger.debug("Получено %s пользователей со смещением %s из %s", len(rows), offset, total)
+    return grouped, total
 
 def update_user_info(telegram_id, username=None, comment=None):
     """Обновляет информацию о пользователе (имя и/или комментарий)."""
-    conn = get_connection()
-    cur = conn.cursor()
+    if username is None and comment is None:
+        return False  # Нечего обновлять
+
     try:
-        update_fields = []
-        params = []
-        
-        if username is not None:
-            update_fields.append("username = %s")
-            params.append(username)
-        
-        if comment is not None:
-            update_fields.append("comment = %s")
-            params.append(comment)
-        
-        if not update_fields:
-            return False  # Нечего обновлять
-        
-        query = f"UPDATE users SET {', '.join(update_fields)} WHERE telegram_id = %s"
-        params.append(telegram_id)
-        
-        cur.execute(query, params)
-        updated = cur.rowcount > 0
-        conn.commit()
-        
-        if updated:
-            logger.info(f"Информация пользователя {telegram_id} успешно обновлена")
-        else:
-            logger.info(f"Пользователь {telegram_id} не найден для обновления")
-        return updated
+        with db_cursor(commit=True) as cur:
+            execute_prepared(cur, "update_user_info", (telegram_id, username, comment))
+            updated = cur.fetchone() is not None
     except Exception as e:
-        logger.error(f"Ошибка при обновлении информации пользователя {telegram_id}: {e}")
-        conn.rollback()
+        log_db_error(e, "Ошибка при обновлении информации пользователя %s: %s", telegram_id)
         return False
-    finally:
-        cur.close()
-        release_connection(conn)
+
+    if updated:
+        logger.info("Информация пользователя %s успешно обновлена", telegram_id)
+    else:
+        logger.info("Пользователь %s не найден для обновления", telegram_id)
+    return updated
+
+def batch_update_users(changes):
+    """
+    Обновляет информацию сразу нескольких пользователей одной транзакцией
+    (для одного пользователя есть update_user_info с подготовленным запросом).
+    changes - список кортежей (telegram_id, username, comment); None оставляет поле без изменений.
+    Возвращает количество обновленных пользователей.
+    """
+    if not changes:
+        return 0
+
+    try:
+        with db_cursor(commit=True) as cur:
+            # Большой список execute_values отправляет несколькими командами, поэтому
+            # обновленные строки считаются по RETURNING всех страниц, а не по rowcount
+            updated = execute_values(
+                cur,
+                """
+                UPDATE users
+                SET username = COALESCE(data.username, users.username),
+                    comment = COALESCE(data.comment, users.comment)
+                FROM (VALUES %s) AS data(telegram_id, username, comment)
+                WHERE users.telegram_id = data.telegram_id
+                RETURNING users.telegram_id
+                """,
+                changes,
+                template="(%s::bigint, %s::text, %s::text)",
+                fetch=True,
+            )
+    except Exception as e:
+        log_db_error(e, "Ошибка при обновлении информации пользователей %s: %s", [change[0] for change in changes])
+        return 0
+
+    logger.debug("Обновлено пользователей: %s из %s", len(updated), len(changes))
+    return len(updated)
 
 def get_user_info(telegram_id):
     """Получает информацию о пользователе."""
-    conn = get_connection()
-    cur = conn.cursor()
     try:
-        cur.execute(
-            "SELECT business_type, username, comment FROM users WHERE telegram_id = %s", 
-            (telegram_id,)
-        )
-        result = cur.fetchone()
-        return result if result else None
+        with db_cursor() as cur:
+            execute_prepared(cur, "user_info", (telegram_id,))
+            return cur.fetchone()
     except Exception as e:
-        logger.error(f"Ошибка при получении информации о пользователе {telegram_id}: {e}")
+        log_db_error(e, "Ошибка при получении информации о пользователе %s: %s", telegram_id)
         return None
-    finally:
-        cur.close()
-        release_connection(conn)
 
 def add_user(telegram_id, business_type, username=None, comment=None):
-    """Добавляет нового пользователя в базу данных."""
-    conn = get_connection()
-    cur = conn.cursor()
+    """
+    Добавляет нового пользователя в базу данных или переносит существующего к другому типу бизнеса.
+    Возвращает True если пользователь добавлен, False если перенесен, None при ошибке.
+    """
     try:
-        cur.execute(
-            """
-            INSERT INTO users (telegram_id, business_type, username, comment) 
-            VALUES (%s, %s, %s, %s) 
-            ON CONFLICT (telegram_id) DO UPDATE 
-            SET business_type = %s, 
-                username = COALESCE(%s, users.username), 
-                comment = COALESCE(%s, users.comment)
-            """,
-            (telegram_id, business_type, username, comment, business_type, username, comment)
-        )
-        conn.commit()
-        logger.info(f"Пользователь {telegram_id} успешно добавлен с типом бизнеса '{business_type}'")
-        return True
+        with db_cursor(commit=True) as cur:
+            execute_prepared(cur, "upsert_user", (telegram_id, business_type, username, comment))
+            inserted = cur.fetchone()[0]
     except Exception as e:
-        logger.error(f"Ошибка при добавлении пользователя {telegram_id}: {e}")
-        conn.rollback()
-        return False
-    finally:
-        cur.close()
-        release_connection(conn)
+        log_db_error(e, "Ошибка при добавлении пользователя %s: %s", telegram_id)
+        return None
+    logger.info("Пользователь %s успешно %s с типом бизнеса '%s'", telegram_id, "добавлен" if inserted else "перенесен", business_type)
+    return inserted
 
 def remove_user(telegram_id):
     """Удаляет пользователя из базы данных."""
-    conn = get_connection()
-    cur = conn.cursor()
     try:
-        cur.execute("DELETE FROM users WHERE telegram_id = %s", (telegram_id,))
-        deleted = cur.rowcount > 0
-        conn.commit()
-        if deleted:
-            logger.info(f"Пользователь {telegram_id} успешно удален")
-        else:
-            logger.info(f"Пользователь {telegram_id} не найден для удаления")
-        return deleted
+        with db_cursor(commit=True) as cur:
+            execute_prepared(cur, "delete_user", (telegram_id,))
+            deleted = cur.fetchone() is not None
     except Exception as e:
-        logger.error(f"Ошибка при удалении пользователя {telegram_id}: {e}")
-        conn.rollback()
+        log_db_error(e, "Ошибка при удалении пользователя %s: %s", telegram_id)
         return False
-    finally:
-        cur.close()
-        release_connection(conn)
+    if deleted:
+        logger.info("Пользователь %s успешно удален", telegram_id)
+    else:
+        logger.info("Пользователь %s не найден для удаления", telegram_id)
+    return deleted
 
 def get_questions_for_business_type(business_type):
-    """Получает список вопросов для указанного типа бизнеса."""
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute(
-            "SELECT id, question_text, question_order FROM questions WHERE business_type = %s ORDER BY question_order",
-            (business_type,)
-        )
-        questions = [(row[0], row[1], row[2]) for row in cur.fetchall()]
-        logger.info(f"Получено {len(questions)} вопросов для типа бизнеса '{business_type}'")
+    """Получает список вопросов для указанного типа бизнеса (из кэша или из базы данных)."""
+    with _cache_lock:
+        questions = _questions_cache.get(business_type)
+    if questions is not None:
         return questions
+    try:
+        with db_cursor() as cur:
+            execute_prepared(cur, "questions_by_type", (business_type,))
+            questions = cur.fetchall()
     except Exception as e:
-        logger.error(f"Ошибка при получении вопросов для типа бизнеса '{business_type}': {e}")
+        log_db_error(e, "Ошибка при получении вопросов для типа бизнеса '%s': %s", business_type)
         return []
-    finally:
-        cur.close()
-        release_connection(conn)
+    logger.debug("Получено %s вопросов для типа бизнеса '%s'", len(questions), business_type)
+    with _cache_lock:
+        _questions_cache[business_type] = questions
+    return questions
 
 def add_business_type(business_type):
     """Добавляет новый тип бизнеса и стандартные вопросы для него."""
-    conn = get_connection()
-    cur = conn.cursor()
     try:
-        standard_questions = [
-            "Что именно вас приятно удивило или впечатлило при посещении?",
-            "Какие качества персонала вызвали у вас доверие и помогли почувствовать себя комфортно?",
-            "Как изменилось ваше состояние или решилась проблема после обращения?",
-            "Почему бы вы порекомендовали нас друзьям или родственникам?"
-        ]
-        for i, question in enumerate(standard_questions):
-            cur.execute(
-                "INSERT INTO questions (business_type, question_text, question_order) VALUES (%s, %s, %s)",
-                (business_type, question, i)
-            )
-        standard_prompt = "На основе следующих ответов составь отзыв:\n\n{}\n\nСоставь связный, теплый отзыв, будто писал клиент, который остался доволен сервисом."
-        cur.execute(
-            "INSERT INTO prompts (business_type, prompt_text) VALUES (%s, %s) ON CONFLICT (business_type) DO UPDATE SET prompt_text = %s",
-            (business_type, standard_prompt, standard_prompt)
-        )
-        conn.commit()
-        logger.info(f"Тип бизнеса '{business_type}' успешно добавлен со стандартными вопросами и промптом")
-        return True
+        with db_cursor(commit=True) as cur:
+            execute_prepared(cur, "create_business_type", (business_type, list(STANDARD_QUESTIONS), DEFAULT_PROMPT))
     except Exception as e:
-        logger.error(f"Ошибка при добавлении типа бизнеса '{business_type}': {e}")
-        conn.rollback()
+        log_db_error(e, "Ошибка при добавлении типа бизнеса '%s': %s", business_type)
         return False
-    finally:
-        cur.close()
-        release_connection(conn)
+    invalidate_business_types_cache()
+    invalidate_questions_cache(business_type)
+    invalidate_prompts_cache()
+    logger.info("Тип бизнеса '%s' успешно добавлен со стандартными вопросами и промптом", business_type)
+    return True
 
-def add_question(business_type, question_text, question_order):
-    """Добавляет новый вопрос для указанного типа бизнеса."""
-    conn = get_connection()
-    cur = conn.cursor()
+def add_question(business_type, question_text):
+    """Добавляет новый вопрос в конец списка вопросов указанного типа бизнеса."""
     try:
-        cur.execute(
-            "INSERT INTO questions (business_type, question_text, question_order) VALUES (%s, %s, %s)",
-            (business_type, question_text, question_order)
-        )
-        conn.commit()
-        logger.info(f"Вопрос '{question_text}' добавлен для типа бизнеса '{business_type}'")
-        return True
+        with db_cursor(commit=True) as cur:
+            execute_prepared(cur, "insert_question", (business_type, question_text))
     except Exception as e:
-        logger.error(f"Ошибка при добавлении вопроса для типа бизнеса '{business_type}': {e}")
-        conn.rollback()
+        log_db_error(e, "Ошибка при добавлении вопроса для типа бизнеса '%s': %s", business_type)
         return False
-    finally:
-        cur.close()
-        release_connection(conn)
+    invalidate_questions_cache(business_type)
+    logger.info("Вопрос '%s' добавлен для типа бизнеса '%s'", question_text, business_type)
+    return True
 
 def update_question(question_id, new_text):
     """Обновляет текст вопроса."""
-    conn = get_connection()
-    cur = conn.cursor()
     try:
-        cur.execute(
-            "UPDATE questions SET question_text = %s WHERE id = %s",
-            (new_text, question_id)
-        )
-        conn.commit()
-        logger.info(f"Вопрос с ID {question_id} успешно обновлен")
-        return True
+        with db_cursor(commit=True) as cur:
+            cur.execute(
+                "UPDATE questions SET question_text = %s WHERE id = %s RETURNING business_type",
+                (new_text, question_id)
+            )
+            row = cur.fetchone()
     except Exception as e:
-        logger.error(f"Ошибка при обновлении вопроса с ID {question_id}: {e}")
-        conn.rollback()
+        log_db_error(e, "Ошибка при обновлении вопроса с ID %s: %s", question_id)
         return False
-    finally:
-        cur.close()
-        release_connection(conn)
+    updated = row is not None
+    if updated:
+        invalidate_questions_cache(row[0])
+        logger.info("Вопрос с ID %s успешно обновлен", question_id)
+    else:
+        logger.info("Вопрос с ID %s не найден для обновления", question_id)
+    return updated
 
-def get_prompt(business_type):
-    """Получает промпт для указанного типа бизнеса."""
-    conn = get_connection()
-    cur = conn.cursor()
+def get_prompts(refresh=False):
+    """Получает промпты всех типов бизнеса в виде словаря (из кэша или, при refresh=True, из базы данных)."""
+    if not refresh:
+        with _cache_lock:
+            prompts = _prompts_cache.get("all")
+        if prompts is not None:
+            return prompts
     try:
-        cur.execute("SELECT prompt_text FROM prompts WHERE business_type = %s", (business_type,))
-        result = cur.fetchone()
-        prompt = result[0] if result else "На основе следующих ответов составь отзыв:\n\n{}\n\nСоставь связный, теплый отзыв, будто писал клиент, который остался доволен сервисом."
-        logger.info(f"Получен промпт для типа бизнеса '{business_type}'")
-        return prompt
+        with db_cursor() as cur:
+            execute_prepared(cur, "all_prompts")
+            prompts = dict(cur)
     except Exception as e:
-        logger.error(f"Ошибка при получении промпта для типа бизнеса '{business_type}': {e}")
-        return "На основе следующих ответов составь отзыв:\n\n{}\n\nСоставь связный, теплый отзыв, будто писал клиент, который остался доволен сервисом."
-    finally:
-        cur.close()
-        release_connection(conn)
+        log_db_error(e, "Ошибка при получении промптов: %s")
+        return {}
+    logger.debug("Получено %s промптов", len(prompts))
+    with _cache_lock:
+        _prompts_cache["all"] = prompts
+    return prompts
+
+def get_prompt(business_type):
+    """Получает промпт для указанного типа бизнеса."""
+    return get_prompts().get(business_type, DEFAULT_PROMPT)
 
 def update_prompt(business_type, new_prompt):
     """Обновляет промпт для указанного типа бизнеса."""
-    conn = get_connection()
-    cur = conn.cursor()
     try:
-        cur.execute(
-            "INSERT INTO prompts (business_type, prompt_text) VALUES (%s, %s) ON CONFLICT (business_type) DO UPDATE SET prompt_text = %s",
-            (business_type, new_prompt, new_prompt)
-        )
-        conn.commit()
-        logger.info(f"Промпт для типа бизнеса '{business_type}' успешно обновлен")
-        return True
+        with db_cursor(commit=True) as cur:
+            execute_prepared(cur, "upsert_prompt", (business_type, new_prompt))
+            updated = cur.fetchone() is not None
     except Exception as e:
-        logger.error(f"Ошибка при обновлении промпта для типа бизнеса '{business_type}': {e}")
-        conn.rollback()
+        log_db_error(e, "Ошибка при обновлении промпта для типа бизнеса '%s': %s", business_type)
         return False
-    finally:
-        cur.close()
-        release_connection(conn)
+    invalidate_prompts_cache()
+    logger.info("Промпт для типа бизнеса '%s' успешно обновлен", business_type)
+    return updated
 
 # --- Обработчики команд ---
+def answer_callback(update: Update, context: CallbackContext) -> None:
+    """
+    Подтверждает нажатие кнопки. Обработчики диалога уже выполняются в пуле потоков
+    диспетчера, поэтому ответ отправляется сразу, без отдельной задачи в том же пуле.
+    """
+    update.callback_query.answer()
+
+def edit_callback_message(update: Update, text, reply_markup=None) -> None:
+    """Редактирует сообщение с кнопками, если его текст или клавиатура действительно меняются."""
+    query = update.callback_query
+    message = query.message
+    # Повторное нажатие на тот же пункт не тратит запрос к Telegram
+    if message is not None and message.text == text and message.reply_markup == reply_markup:
+        return
+    try:
+        query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Текст мог совпасть после нормализации на стороне Telegram
+        if "not modified" not in str(e):
+            raise
+
+# Telegram не принимает сообщения длиннее 4096 символов. Символы считаются
+# в кодовых единицах UTF-16: эмодзи и другие символы вне BMP занимают две
+MAX_MESSAGE_LENGTH = 4096
+
+def utf16_length(text):
+    """Длина текста так, как ее считает Telegram (в кодовых единицах UTF-16)."""
+    return len(text.encode("utf-16-le")) // 2
+
+def fit_message(text, limit=MAX_MESSAGE_LENGTH):
+    """Обрезает текст до limit кодовых единиц UTF-16 (по умолчанию до длины сообщения Telegram) по границе строки."""
+    if utf16_length(text) <= limit:
+        return text
+    suffix = "\n…"
+    # Префикс, помещающийся в лимит; неполная суррогатная пара на границе отбрасывается
+    head = text.encode("utf-16-le")[:2 * (limit - utf16_length(suffix))].decode("utf-16-le", errors="ignore")
+    # По границе строки режем, только если она не отбрасывает больше половины текста
+    cut = head.rfind("\n")
+    return head[:cut if cut > len(head) // 2 else len(head)] + suffix
+
+@lru_cache(maxsize=32)
+def business_types_markup(callback_prefix, business_types, back_data, with_add_button=False):
+    """
+    Клавиатура выбора типа бизнеса. Строится один раз на каждый набор типов
+    (business_types передается кортежем) и дальше переиспользуется.
+    """
+    keyboard = [[InlineKeyboardButton(btype, callback_data=f"{callback_prefix}:{btype}")] for btype in business_types]
+    if with_add_button:
+        keyboard.append([InlineKeyboardButton("➕ Добавить новый тип", callback_data="add_business_type")])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=back_data)])
+    return StaticKeyboardMarkup(keyboard)
+
+def show_no_business_types(update: Update, reply_markup) -> int:
+    """Сообщает, что типов бизнеса еще нет, и предлагает добавить первый."""
+    update.callback_query.edit_message_text("Нет доступных типов бизнеса. Сначала добавьте тип бизнеса:", reply_markup=reply_markup)
+    logger.info("Нет типов бизнеса, предложено добавить новый")
+    return SELECT_BUSINESS_TYPE
+
+# Пользователей на одной странице списка: текст укладывается в лимит сообщения,
+# а кнопки выбора пользователя — в лимит клавиатуры Telegram
+USER_LIST_PAGE_SIZE = 50
+
 def start(update: Update, context: CallbackContext) -> int:
     """Начало разговора и проверка прав администратора."""
     user_id = update.effective_user.id
-    logger.info(f"Команда /start от пользователя {user_id}")
+    logger.info("Команда /start от пользователя %s", user_id)
     if not is_admin(user_id):
         update.message.reply_text("У вас нет прав для использования этого бота.")
-        logger.warning(f"Пользователь {user_id} не имеет прав администратора")
+        logger.warning("Пользователь %s не имеет прав администратора", user_id)
         return ConversationHandler.END
     return show_main_menu(update, context)
 
 def show_main_menu(update: Update, context: CallbackContext) -> int:
     """Показывает главное меню администратора."""
-    keyboard = [
-        [InlineKeyboardButton("👥 Управление пользователями", callback_data="manage_users")],
-        [InlineKeyboardButton("❓ Управление вопросами", callback_data="manage_questions")],
-        [InlineKeyboardButton("📝 Управление промптами", callback_data="manage_prompts")],
-        [InlineKeyboardButton("❌ Выход", callback_data="exit")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     if update.message:
-        update.message.reply_text("🔧 Панель администратора:", reply_markup=reply_markup)
+        update.message.reply_text("🔧 Панель администратора:", reply_markup=_MAIN_MENU_MARKUP)
         logger.info("Отображено главное меню через сообщение")
     else:
-        update.callback_query.edit_message_text("🔧 Панель администратора:", reply_markup=reply_markup)
+        update.callback_query.edit_message_text("🔧 Панель администратора:", reply_markup=_MAIN_MENU_MARKUP)
         logger.info("Отображено главное меню через callback")
     return MAIN_MENU
 
 def main_menu_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает выбор в главном меню."""
     query = update.callback_query
-    query.answer()
-    logger.info(f"Обработка выбора в главном меню: {query.data}")
-    if query.data == "manage_users":
-        return show_user_management(update, context)
-    elif query.data == "manage_questions":
-        return show_question_management(update, context)
-    elif query.data == "manage_prompts":
-        return show_prompt_management(update, context)
-    elif query.data == "exit":
-        query.edit_message_text("Выход из панели администратора.")
-        logger.info("Выход из панели администратора")
-        return ConversationHandler.END
-    return show_main_menu(update, context)
+    answer_callback(update, context)
+    logger.info("Обработка выбора в главном меню: %s", query.data)
+    return _MAIN_MENU_ROUTES.get(query.data, show_main_menu)(update, context)
+
+def exit_admin_panel(update: Update, context: CallbackContext) -> int:
+    """Завершает работу с панелью администратора."""
+    update.callback_query.edit_message_text("Выход из панели администратора.")
+    logger.info("Выход из панели администратора")
+    return ConversationHandler.END
 
 # --- Управление пользователями ---
 def show_user_management(update: Update, context: CallbackContext) -> int:
     """Показывает меню управления пользователями."""
-    keyboard = [
-        [InlineKeyboardButton("➕ Добавить пользователя", callback_data="add_user")],
-        [InlineKeyboardButton("➖ Удалить пользователя", callback_data="remove_user")],
-        [InlineKeyboardButton("📋 Список пользователей", callback_data="list_users")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.callback_query.edit_message_text("👥 Управление пользователями:", reply_markup=reply_markup)
+    update.callback_query.edit_message_text("👥 Управление пользователями:", reply_markup=_USER_MGMT_MARKUP)
     logger.info("Отображено меню управления пользователями")
     return MANAGE_USERS
 
 def user_management_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает выбор в меню управления пользователями."""
     query = update.callback_query
-    query.answer()
-    logger.info(f"Обработка выбора в меню управления пользователями: {query.data}")
-    if query.data == "add_user":
-        business_types = get_business_types()
-        if not business_types:
-            keyboard = [
-                [InlineKeyboardButton("➕ Добавить тип бизнеса", callback_data="add_business_type")],
-                [InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_management")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            query.edit_message_text("Нет доступных типов бизнеса. Сначала добавьте тип бизнеса:", reply_markup=reply_markup)
-            logger.info("Нет типов бизнеса, предложено добавить новый")
-            return SELECT_BUSINESS_TYPE
-        keyboard = [[InlineKeyboardButton(btype, callback_data=f"select_type:{btype}")] for btype in business_types]
-        keyboard.append([InlineKeyboardButton("➕ Добавить новый тип", callback_data="add_business_type")])
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_management")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        query.edit_message_text("Выберите тип бизнеса для нового пользователя:", reply_markup=reply_markup)
-        logger.info("Отображен выбор типов бизнеса для добавления пользователя")
-        return SELECT_BUSINESS_TYPE
-    elif query.data == "remove_user":
-        query.edit_message_text("Введите Telegram ID пользователя, которого хотите удалить:")
-        logger.info("Запрошено удаление пользователя")
-        return REMOVE_USER
-    elif query.data == "list_users":
-        return show_user_list(update, context)
-    elif query.data == "back_to_main":
-        return show_main_menu(update, context)
-    return MANAGE_USERS
+    answer_callback(update, context)
+    logger.info("Обработка выбора в меню управления пользователями: %s", query.data)
+    handler = _USER_MANAGEMENT_ROUTES.get(query.data)
+    if handler is None:
+        return MANAGE_USERS
+    return handler(update, context)
 
-def show_user_list(update: Update, context: CallbackContext) -> int:
-    """Показывает список пользователей по типам бизнеса."""
+def show_business_type_selection(update: Update, context: CallbackContext) -> int:
+    """Показывает выбор типа бизнеса для нового пользователя."""
+    query = update.callback_query
     business_types = get_business_types()
     if not business_types:
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_management")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        update.callback_query.edit_message_text("Нет зарегистрированных пользователей.", reply_markup=reply_markup)
+        return show_no_business_types(update, _NO_TYPES_FROM_USERS_MARKUP)
+    reply_markup = business_types_markup("select_type", tuple(business_types), "back_to_user_management", with_add_button=True)
+    query.edit_message_text("Выберите тип бизнеса для нового пользователя:", reply_markup=reply_markup)
+    logger.info("Отображен выбор типов бизнеса для добавления пользователя")
+    return SELECT_BUSINESS_TYPE
+
+def request_remove_user(update: Update, context: CallbackContext) -> int:
+    """Запрашивает Telegram ID пользователя для удаления."""
+    update.callback_query.edit_message_text("Введите Telegram ID пользователя, которого хотите удалить:")
+    logger.info("Запрошено удаление пользователя")
+    return REMOVE_USER
+
+def show_user_list(update: Update, context: CallbackContext, page=0) -> int:
+    """Показывает список пользователей по типам бизнеса (постранично)."""
+    users_by_type, total = get_users_page(page * USER_LIST_PAGE_SIZE, USER_LIST_PAGE_SIZE)
+    if not users_by_type and total == 0 and page > 0:
+        # Страница могла опустеть после удаления пользователей: показываем последнюю
+        _, total = get_users_page(0, 1)
+        page = max((total - 1) // USER_LIST_PAGE_SIZE, 0)
+        users_by_type, total = get_users_page(page * USER_LIST_PAGE_SIZE, USER_LIST_PAGE_SIZE)
+    if not users_by_type:
+        update.callback_query.edit_message_text("Нет зарегистрированных пользователей.", reply_markup=_BACK_TO_USER_MGMT_MARKUP)
         logger.info("Нет зарегистрированных пользователей")
         return LIST_USERS
     
-    message_text = "📋 Список пользователей по типам бизнеса:\n\n"
+    # Строки собираются в список и склеиваются один раз в конце
+    lines = []
     all_users = []  # Список для хранения всех пользователей для кнопок
+    users_by_id = {}  # Данные для карточки пользователя без повторного запроса
     
-    for btype in business_types:
-        users = get_users_by_business_type(btype)
-        message_text += f"📌 {btype} ({len(users)} пользователей):\n"
+    for btype, (count, users) in users_by_type.items():
+        lines.append(f"📌 {btype} ({count} пользователей):")
         for user_id, username, comment in users:
             # Форматируем отображение пользователя
             user_info = f"   - ID: {user_id}"
@@ -489,75 +929,100 @@ def show_user_list(update: Update, context: CallbackContext) -> int:
                     info_parts.append(comment)
                 user_info += f" ({', '.join(info_parts)})"
             
-            message_text += f"{user_info}\n"
+            lines.append(user_info)
             all_users.append((user_id, display_name))
+            users_by_id[user_id] = (btype, username, comment)
         
-        message_text += "\n"
+        lines.append("")
     
-    # Сохраняем список пользователей в контексте для использования в кнопках
+    # Сохраняем пользователей текущей страницы в контексте для использования в кнопках
     context.user_data["all_users"] = all_users
+    context.user_data["users_by_id"] = users_by_id
+    context.user_data["user_list_page"] = page
     
-    keyboard = [
-        [InlineKeyboardButton("✏️ Добавить/изменить имя или комментарий", callback_data="select_user_to_edit")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_management")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    page_count = (total + USER_LIST_PAGE_SIZE - 1) // USER_LIST_PAGE_SIZE
+    header = "📋 Список пользователей по типам бизнеса"
+    if page_count > 1:
+        header += f" (стр. {page + 1}/{page_count})"
+    message_text = fit_message(f"{header}:\n\n" + "\n".join(lines))
+    
+    if page_count > 1:
+        nav_row = []
+        if page > 0:
+            nav_row.append(InlineKeyboardButton("◀️", callback_data=f"user_list_page:{page - 1}"))
+        if page < page_count - 1:
+            nav_row.append(InlineKeyboardButton("▶️", callback_data=f"user_list_page:{page + 1}"))
+        reply_markup = InlineKeyboardMarkup([nav_row] + _USER_LIST_MARKUP.inline_keyboard)
+    else:
+        reply_markup = _USER_LIST_MARKUP
     update.callback_query.edit_message_text(message_text, reply_markup=reply_markup)
-    logger.info("Отображен список пользователей")
+    logger.info("Отображен список пользователей, страница %s из %s", page + 1, page_count)
     return LIST_USERS
 
+def show_current_user_list(update: Update, context: CallbackContext) -> int:
+    """Показывает ту страницу списка пользователей, с которой ушли."""
+    return show_user_list(update, context, page=context.user_data.get("user_list_page", 0))
+
+def back_to_user_list_handler(update: Update, context: CallbackContext) -> int:
+    """Возвращает к той странице списка пользователей, с которой ушли."""
+    answer_callback(update, context)
+    return show_current_user_list(update, context)
+
+def user_list_page_handler(update: Update, context: CallbackContext) -> int:
+    """Переключает страницу списка пользователей."""
+    answer_callback(update, context)
+    return show_user_list(update, context, page=int(context.matches[0].group("page_number")))
+
+def request_new_business_type(update: Update, context: CallbackContext) -> int:
+    """Запрашивает название нового типа бизнеса."""
+    update.callback_query.edit_message_text("Введите название нового типа бизнеса:")
+    return ADD_BUSINESS_TYPE
+
 def business_type_selection_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает выбор типа бизнеса."""
     query = update.callback_query
-    query.answer()
-    logger.info(f"Обработка выбора типа бизнеса: {query.data}")
-    if query.data == "add_business_type":
-        query.edit_message_text("Введите название нового типа бизнеса:")
-        return ADD_BUSINESS_TYPE
-    elif query.data == "back_to_user_management":
-        return show_user_management(update, context)
-    elif query.data.startswith("select_type:"):
-        business_type = query.data.split(":", 1)[1]
+    answer_callback(update, context)
+    logger.info("Обработка выбора типа бизнеса: %s", query.data)
+    handler = _BUSINESS_TYPE_SELECTION_ROUTES.get(query.data)
+    if handler is not None:
+        return handler(update, context)
+    match = _SELECT_TYPE_PATTERN.match(query.data)
+    if match:
+        business_type = match.group(1)
         context.user_data["selected_business_type"] = business_type
         query.edit_message_text(f"Выбран тип бизнеса: {business_type}\nВведите Telegram ID нового пользователя:")
-        logger.info(f"Выбран тип бизнеса: {business_type}")
+        logger.info("Выбран тип бизнеса: %s", business_type)
         return ADD_USER
     return SELECT_BUSINESS_TYPE
 
 def add_business_type_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает добавление нового типа бизнеса."""
     business_type = update.message.text.strip()
-    logger.info(f"Попытка добавить тип бизнеса: {business_type}")
+    logger.info("Попытка добавить тип бизнеса: %s", business_type)
     if add_business_type(business_type):
         context.user_data["selected_business_type"] = business_type
-        keyboard = [
-            [InlineKeyboardButton("➕ Добавить пользователя", callback_data="add_user_for_new_type")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_management")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         update.message.reply_text(
             f"✅ Тип бизнеса '{business_type}' успешно добавлен со стандартными вопросами.",
-            reply_markup=reply_markup
+            reply_markup=_NEW_TYPE_ADDED_MARKUP
         )
-        logger.info(f"Тип бизнеса '{business_type}' успешно добавлен")
+        logger.info("Тип бизнеса '%s' успешно добавлен", business_type)
         return SELECT_BUSINESS_TYPE
     else:
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_management")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         update.message.reply_text(
             "❌ Не удалось добавить тип бизнеса. Пожалуйста, попробуйте еще раз.",
-            reply_markup=reply_markup
+            reply_markup=_BACK_TO_USER_MGMT_MARKUP
         )
-        logger.error(f"Не удалось добавить тип бизнеса '{business_type}'")
-        return SELECT_BUSINESS_TYPE
+        logger.error("Не удалось добавить тип бизнеса '%s'", business_type)
+        # Остаемся в ожидании названия: следующее сообщение будет повторной попыткой
+        return ADD_BUSINESS_TYPE
 
 def add_user_for_new_type_handler(update: Update, context: CallbackContext) -> int:
     """Переход к добавлению пользователя после создания нового типа бизнеса."""
     query = update.callback_query
-    query.answer()
+    answer_callback(update, context)
     business_type = context.user_data.get("selected_business_type")
     query.edit_message_text(f"Выбран тип бизнеса: {business_type}\nВведите Telegram ID нового пользователя:")
-    logger.info(f"Переход к добавлению пользователя для типа бизнеса '{business_type}'")
+    logger.info("Переход к добавлению пользователя для типа бизнеса '%s'", business_type)
     return ADD_USER
 
 def add_user_handler(update: Update, context: CallbackContext) -> int:
@@ -571,64 +1036,78 @@ def add_user_handler(update: Update, context: CallbackContext) -> int:
         username = parts[1] if len(parts) > 1 else None
         
         business_type = context.user_data.get("selected_business_type")
-        logger.info(f"Попытка добавить пользователя {telegram_id} с типом бизнеса '{business_type}', имя: {username}")
+        logger.info("Попытка добавить пользователя %s с типом бизнеса '%s', имя: %s", telegram_id, business_type, username)
         
-        if add_user(telegram_id, business_type, username):
-            if username:
-                update.message.reply_text(f"✅ Пользователь с ID {telegram_id} и именем '{username}' успешно добавлен к типу бизнеса '{business_type}'.")
+        inserted = add_user(telegram_id, business_type, username)
+        if inserted is not None:
+            user_label = f"Пользователь с ID {telegram_id} и именем '{username}'" if username else f"Пользователь с ID {telegram_id}"
+            if inserted:
+                status = f"✅ {user_label} успешно добавлен к типу бизнеса '{business_type}'."
             else:
-                update.message.reply_text(f"✅ Пользователь с ID {telegram_id} успешно добавлен к типу бизнеса '{business_type}'.")
+                status = f"✅ {user_label} перенесен к типу бизнеса '{business_type}'."
         else:
-            update.message.reply_text("❌ Не удалось добавить пользователя. Пожалуйста, попробуйте еще раз.")
-            logger.error(f"Не удалось добавить пользователя {telegram_id}")
+            status = "❌ Не удалось добавить пользователя. Пожалуйста, попробуйте еще раз."
+            logger.error("Не удалось добавить пользователя %s", telegram_id)
     except ValueError:
-        update.message.reply_text("❌ Ошибка: Telegram ID должен быть числом. Пожалуйста, попробуйте еще раз.")
+        status = "❌ Ошибка: Telegram ID должен быть числом. Пожалуйста, попробуйте еще раз."
         logger.error("Введен некорректный Telegram ID")
     
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_management")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
+    # Результат и меню одним сообщением
+    update.message.reply_text(f"{status}\n\nВыберите действие:", reply_markup=_BACK_TO_USER_MGMT_MARKUP)
     return MANAGE_USERS
 
 def remove_user_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает удаление пользователя."""
     try:
         telegram_id = int(update.message.text.strip())
-        logger.info(f"Попытка удалить пользователя {telegram_id}")
+        logger.info("Попытка удалить пользователя %s", telegram_id)
         if remove_user(telegram_id):
-            update.message.reply_text(f"✅ Пользователь с ID {telegram_id} успешно удален.")
+            status = f"✅ Пользователь с ID {telegram_id} успешно удален."
         else:
-            update.message.reply_text(f"❌ Пользователь с ID {telegram_id} не найден.")
-            logger.info(f"Пользователь {telegram_id} не найден")
+            status = f"❌ Пользователь с ID {telegram_id} не найден."
+            logger.info("Пользователь %s не найден", telegram_id)
     except ValueError:
-        update.message.reply_text("❌ Ошибка: Telegram ID должен быть числом. Пожалуйста, попробуйте еще раз.")
+        status = "❌ Ошибка: Telegram ID должен быть числом. Пожалуйста, попробуйте еще раз."
         logger.error("Введен некорректный Telegram ID для удаления")
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_management")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
+    update.message.reply_text(f"{status}\n\nВыберите действие:", reply_markup=_BACK_TO_USER_MGMT_MARKUP)
     return MANAGE_USERS
 
 def user_list_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает выбор в списке пользователей."""
     query = update.callback_query
-    query.answer()
-    logger.info(f"Обработка выбора в списке пользователей: {query.data}")
-    
-    if query.data == "back_to_user_management":
-        return show_user_management(update, context)
-    elif query.data == "select_user_to_edit":
-        return show_user_selection(update, context)
-    
-    return LIST_USERS
+    answer_callback(update, context)
+    logger.info("Обработка выбора в списке пользователей: %s", query.data)
+    handler = _USER_LIST_ROUTES.get(query.data)
+    if handler is None:
+        return LIST_USERS
+    return handler(update, context)
+
+def format_user_card(user_id, user_info) -> str:
+    """Формирует карточку пользователя одной строкой-шаблоном."""
+    business_type, username, comment = user_info
+    return (
+        f"Информация о пользователе ID: {user_id}\n"
+        f"Тип бизнеса: {business_type}\n"
+        f"Имя: {username or 'Не указано'}\n"
+        f"Комментарий: {comment or 'Не указан'}\n"
+    )
+
+def cached_user_info(context: CallbackContext, user_id):
+    """
+    Возвращает (тип бизнеса, имя, комментарий) из последнего показанного списка пользователей,
+    а если пользователя там нет — из базы данных.
+    """
+    user_info = context.user_data.get("users_by_id", {}).get(user_id)
+    if user_info is None:
+        user_info = get_user_info(user_id)
+    return user_info
 
 def show_user_selection(update: Update, context: CallbackContext) -> int:
     """Показывает список пользователей для выбора."""
     all_users = context.user_data.get("all_users", [])
     
     if not all_users:
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_list")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        update.callback_query.edit_message_text("Нет доступных пользователей для редактирования.", reply_markup=reply_markup)
+        update.callback_query.edit_message_text("Нет доступных пользователей для редактирования.", reply_markup=_BACK_TO_USER_LIST_MARKUP)
         return LIST_USERS
     
     # Создаем кнопки для выбора пользователя
@@ -646,33 +1125,20 @@ def show_user_selection(update: Update, context: CallbackContext) -> int:
 def edit_user_info_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает выбор пользователя для редактирования."""
     query = update.callback_query
-    query.answer()
+    answer_callback(update, context)
     
     if query.data == "back_to_user_list":
-        return show_user_list(update, context)
+        return show_current_user_list(update, context)
     
     if query.data.startswith("edit_user:"):
         user_id = int(query.data.split(":", 1)[1])
         context.user_data["edit_user_id"] = user_id
         
-        user_info = get_user_info(user_id)
+        user_info = cached_user_info(context, user_id)
         
         if user_info:
-            business_type, username, comment = user_info
-            
-            message_text = f"Информация о пользователе ID: {user_id}\n"
-            message_text += f"Тип бизнеса: {business_type}\n"
-            message_text += f"Имя: {username or 'Не указано'}\n"
-            message_text += f"Комментарий: {comment or 'Не указан'}\n"
-            
-            keyboard = [
-                [InlineKeyboardButton("✏️ Изменить имя", callback_data="edit_username")],
-                [InlineKeyboardButton("📝 Изменить комментарий", callback_data="edit_comment")],
-                [InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_select")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            query.edit_message_text(message_text, reply_markup=reply_markup)
-            logger.info(f"Отображена информация о пользователе {user_id}")
+            query.edit_message_text(format_user_card(user_id, user_info), reply_markup=_USER_CARD_MARKUP)
+            logger.info("Отображена информация о пользователе %s", user_id)
             return EDIT_USER_INFO
     
     return EDIT_USER_INFO
@@ -680,49 +1146,33 @@ def edit_user_info_handler(update: Update, context: CallbackContext) -> int:
 def edit_user_info_selection_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает выбор действия с информацией пользователя."""
     query = update.callback_query
-    query.answer()
-    logger.info(f"Обработка выбора действия с информацией пользователя: {query.data}")
-    
-    if query.data == "edit_username":
-        keyboard = [[InlineKeyboardButton("🔙 Отмена", callback_data="cancel_edit")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        query.edit_message_text("Введите новое имя пользователя:", reply_markup=reply_markup)
-        return ADD_USERNAME
-    elif query.data == "edit_comment":
-        keyboard = [[InlineKeyboardButton("🔙 Отмена", callback_data="cancel_edit")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        query.edit_message_text("Введите новый комментарий для пользователя:", reply_markup=reply_markup)
-        return ADD_COMMENT
-    elif query.data == "back_to_user_select":
-        return show_user_selection(update, context)
-    elif query.data == "back_to_user_list":
-        return show_user_list(update, context)
-    
-    return EDIT_USER_INFO
+    answer_callback(update, context)
+    logger.info("Обработка выбора действия с информацией пользователя: %s", query.data)
+    handler = _EDIT_USER_INFO_ROUTES.get(query.data)
+    if handler is None:
+        return EDIT_USER_INFO
+    return handler(update, context)
+
+def request_username_edit(update: Update, context: CallbackContext) -> int:
+    """Запрашивает новое имя пользователя."""
+    update.callback_query.edit_message_text("Введите новое имя пользователя:", reply_markup=_CANCEL_EDIT_MARKUP)
+    return ADD_USERNAME
+
+def request_comment_edit(update: Update, context: CallbackContext) -> int:
+    """Запрашивает новый комментарий для пользователя."""
+    update.callback_query.edit_message_text("Введите новый комментарий для пользователя:", reply_markup=_CANCEL_EDIT_MARKUP)
+    return ADD_COMMENT
 
 def cancel_edit_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает отмену редактирования."""
     query = update.callback_query
-    query.answer()
+    answer_callback(update, context)
     
     user_id = context.user_data.get("edit_user_id")
-    user_info = get_user_info(user_id)
+    user_info = cached_user_info(context, user_id)
     
     if user_info:
-        business_type, username, comment = user_info
-        
-        message_text = f"Информация о пользователе ID: {user_id}\n"
-        message_text += f"Тип бизнеса: {business_type}\n"
-        message_text += f"Имя: {username or 'Не указано'}\n"
-        message_text += f"Комментарий: {comment or 'Не указан'}\n"
-        
-        keyboard = [
-            [InlineKeyboardButton("✏️ Изменить имя", callback_data="edit_username")],
-            [InlineKeyboardButton("📝 Изменить комментарий", callback_data="edit_comment")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_user_select")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        query.edit_message_text(message_text, reply_markup=reply_markup)
+        query.edit_message_text(format_user_card(user_id, user_info), reply_markup=_USER_CARD_MARKUP)
         return EDIT_USER_INFO
     
     return show_user_selection(update, context)
@@ -732,7 +1182,7 @@ def add_username_handler(update: Update, context: CallbackContext) -> int:
     # Проверяем, не пришел ли callback для отмены
     if update.callback_query:
         query = update.callback_query
-        query.answer()
+        answer_callback(update, context)
         if query.data == "cancel_edit":
             return cancel_edit_handler(update, context)
     
@@ -740,13 +1190,11 @@ def add_username_handler(update: Update, context: CallbackContext) -> int:
     telegram_id = context.user_data.get("edit_user_id")
     
     if update_user_info(telegram_id, username=username):
-        update.message.reply_text(f"✅ Имя пользователя с ID {telegram_id} успешно обновлено.")
+        status = f"✅ Имя пользователя с ID {telegram_id} успешно обновлено."
     else:
-        update.message.reply_text(f"❌ Не удалось обновить имя пользователя. Пожалуйста, попробуйте еще раз.")
+        status = "❌ Не удалось обновить имя пользователя. Пожалуйста, попробуйте еще раз."
     
-    keyboard = [[InlineKeyboardButton("🔙 Назад к списку пользователей", callback_data="back_to_user_list")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
+    update.message.reply_text(f"{status}\n\nВыберите действие:", reply_markup=_RETURN_TO_USER_LIST_MARKUP)
     return LIST_USERS
 
 def add_comment_handler(update: Update, context: CallbackContext) -> int:
@@ -754,7 +1202,7 @@ def add_comment_handler(update: Update, context: CallbackContext) -> int:
     # Проверяем, не пришел ли callback для отмены
     if update.callback_query:
         query = update.callback_query
-        query.answer()
+        answer_callback(update, context)
         if query.data == "cancel_edit":
             return cancel_edit_handler(update, context)
     
@@ -762,13 +1210,11 @@ def add_comment_handler(update: Update, context: CallbackContext) -> int:
     telegram_id = context.user_data.get("edit_user_id")
     
     if update_user_info(telegram_id, comment=comment):
-        update.message.reply_text(f"✅ Комментарий для пользователя с ID {telegram_id} успешно обновлен.")
+        status = f"✅ Комментарий для пользователя с ID {telegram_id} успешно обновлен."
     else:
-        update.message.reply_text(f"❌ Не удалось обновить комментарий. Пожалуйста, попробуйте еще раз.")
+        status = "❌ Не удалось обновить комментарий. Пожалуйста, попробуйте еще раз."
     
-    keyboard = [[InlineKeyboardButton("🔙 Назад к списку пользователей", callback_data="back_to_user_list")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
+    update.message.reply_text(f"{status}\n\nВыберите действие:", reply_markup=_RETURN_TO_USER_LIST_MARKUP)
     return LIST_USERS
 
 # --- Управление вопросами ---
@@ -776,20 +1222,8 @@ def show_question_management(update: Update, context: CallbackContext) -> int:
     """Показывает меню управления вопросами."""
     business_types = get_business_types()
     if not business_types:
-        keyboard = [
-            [InlineKeyboardButton("➕ Добавить тип бизнеса", callback_data="add_business_type")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        update.callback_query.edit_message_text(
-            "Нет доступных типов бизнеса. Сначала добавьте тип бизнеса:",
-            reply_markup=reply_markup
-        )
-        logger.info("Нет типов бизнеса для управления вопросами")
-        return SELECT_BUSINESS_TYPE
-    keyboard = [[InlineKeyboardButton(btype, callback_data=f"question_type:{btype}")] for btype in business_types]
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        return show_no_business_types(update, _NO_TYPES_FROM_MAIN_MARKUP)
+    reply_markup = business_types_markup("question_type", tuple(business_types), "back_to_main")
     update.callback_query.edit_message_text("Выберите тип бизнеса для управления вопросами:", reply_markup=reply_markup)
     logger.info("Отображено меню управления вопросами")
     return MANAGE_QUESTIONS
@@ -797,12 +1231,13 @@ def show_question_management(update: Update, context: CallbackContext) -> int:
 def question_management_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает выбор в меню управления вопросами."""
     query = update.callback_query
-    query.answer()
-    logger.info(f"Обработка выбора в меню управления вопросами: {query.data}")
+    answer_callback(update, context)
+    logger.info("Обработка выбора в меню управления вопросами: %s", query.data)
     if query.data == "back_to_main":
         return show_main_menu(update, context)
-    elif query.data.startswith("question_type:"):
-        business_type = query.data.split(":", 1)[1]
+    # Тип бизнеса уже выделен шаблоном обработчика
+    business_type = context.matches[0].group("business_type")
+    if business_type is not None:
         context.user_data["selected_business_type"] = business_type
         return show_questions_for_type(update, context, business_type)
     return MANAGE_QUESTIONS
@@ -810,54 +1245,47 @@ def question_management_handler(update: Update, context: CallbackContext) -> int
 def show_questions_for_type(update: Update, context: CallbackContext, business_type) -> int:
     """Показывает список вопросов для указанного типа бизнеса."""
     questions = get_questions_for_business_type(business_type)
-    message_text = f"❓ Вопросы для типа бизнеса '{business_type}':\n\n"
+    lines = [f"❓ Вопросы для типа бизнеса '{business_type}':\n"]
     if not questions:
-        message_text += "Вопросы не найдены."
+        lines.append("Вопросы не найдены.")
     else:
-        for q_id, text, order in questions:
-            message_text += f"{order+1}. {text} [ID: {q_id}]\n"
-    keyboard = [
-        [InlineKeyboardButton("➕ Добавить вопрос", callback_data="add_question")],
-        [InlineKeyboardButton("✏️ Редактировать вопрос", callback_data="edit_question")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_question_management")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.callback_query.edit_message_text(message_text, reply_markup=reply_markup)
-    logger.info(f"Отображены вопросы для типа бизнеса '{business_type}'")
+        lines.extend(f"{order+1}. {text} [ID: {q_id}]" for q_id, text, order in questions)
+    message_text = fit_message("\n".join(lines))
+    update.callback_query.edit_message_text(message_text, reply_markup=_QUESTION_ACTIONS_MARKUP)
+    logger.info("Отображены вопросы для типа бизнеса '%s'", business_type)
     return MANAGE_QUESTIONS
 
 def question_action_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает действия с вопросами."""
     query = update.callback_query
-    query.answer()
-    logger.info(f"Обработка действия с вопросами: {query.data}")
-    if query.data == "add_question":
-        business_type = context.user_data.get("selected_business_type")
-        questions = get_questions_for_business_type(business_type)
-        next_order = len(questions)
-        query.edit_message_text(f"Введите текст нового вопроса для типа бизнеса '{business_type}':")
-        context.user_data["next_question_order"] = next_order
-        return ADD_QUESTION_FOR_TYPE
-    elif query.data == "edit_question":
-        query.edit_message_text("Введите ID вопроса, который хотите отредактировать:")
-        return EDIT_QUESTION
-    elif query.data == "back_to_question_management":
-        return show_question_management(update, context)
-    return MANAGE_QUESTIONS
+    answer_callback(update, context)
+    logger.info("Обработка действия с вопросами: %s", query.data)
+    handler = _QUESTION_ACTION_ROUTES.get(query.data)
+    if handler is None:
+        return MANAGE_QUESTIONS
+    return handler(update, context)
+
+def request_new_question(update: Update, context: CallbackContext) -> int:
+    """Запрашивает текст нового вопроса для выбранного типа бизнеса."""
+    business_type = context.user_data.get("selected_business_type")
+    update.callback_query.edit_message_text(f"Введите текст нового вопроса для типа бизнеса '{business_type}':")
+    return ADD_QUESTION_FOR_TYPE
+
+def request_question_edit(update: Update, context: CallbackContext) -> int:
+    """Запрашивает ID вопроса для редактирования."""
+    update.callback_query.edit_message_text("Введите ID вопроса, который хотите отредактировать:")
+    return EDIT_QUESTION
 
 def add_question_for_type_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает добавление нового вопроса."""
     question_text = update.message.text.strip()
     business_type = context.user_data.get("selected_business_type")
-    question_order = context.user_data.get("next_question_order", 0)
-    logger.info(f"Попытка добавить вопрос '{question_text}' для типа бизнеса '{business_type}'")
-    if add_question(business_type, question_text, question_order):
-        update.message.reply_text(f"✅ Вопрос успешно добавлен для типа бизнеса '{business_type}'.")
+    logger.info("Попытка добавить вопрос '%s' для типа бизнеса '%s'", question_text, business_type)
+    if add_question(business_type, question_text):
+        status = f"✅ Вопрос успешно добавлен для типа бизнеса '{business_type}'."
     else:
-        update.message.reply_text("❌ Не удалось добавить вопрос. Пожалуйста, попробуйте еще раз.")
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_question_type")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
+        status = "❌ Не удалось добавить вопрос. Пожалуйста, попробуйте еще раз."
+    update.message.reply_text(f"{status}\n\nВыберите действие:", reply_markup=_BACK_TO_QUESTION_TYPE_MARKUP)
     return MANAGE_QUESTIONS
 
 def edit_question_handler(update: Update, context: CallbackContext) -> int:
@@ -866,36 +1294,33 @@ def edit_question_handler(update: Update, context: CallbackContext) -> int:
         question_id = int(update.message.text.strip())
         context.user_data["edit_question_id"] = question_id
         update.message.reply_text("Введите новый текст вопроса:")
-        logger.info(f"Запрошено редактирование вопроса с ID {question_id}")
+        logger.info("Запрошено редактирование вопроса с ID %s", question_id)
         return EDIT_QUESTION
     except ValueError:
-        update.message.reply_text("❌ Ошибка: ID вопроса должен быть числом. Пожалуйста, попробуйте еще раз.")
         logger.error("Введен некорректный ID вопроса")
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_question_type")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
+        update.message.reply_text(
+            "❌ Ошибка: ID вопроса должен быть числом. Пожалуйста, попробуйте еще раз.\n\nВыберите действие:",
+            reply_markup=_BACK_TO_QUESTION_TYPE_MARKUP
+        )
         return MANAGE_QUESTIONS
 
 def update_question_text_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает ввод нового текста вопроса."""
     question_id = context.user_data.get("edit_question_id")
     new_text = update.message.text.strip()
-    logger.info(f"Попытка обновить вопрос с ID {question_id} на '{new_text}'")
+    logger.info("Попытка обновить вопрос с ID %s на '%s'", question_id, new_text)
     if update_question(question_id, new_text):
-        update.message.reply_text(f"✅ Текст вопроса с ID {question_id} успешно обновлен.")
+        status = f"✅ Текст вопроса с ID {question_id} успешно обновлен."
     else:
-        update.message.reply_text(f"❌ Не удалось обновить вопрос с ID {question_id}. Пожалуйста, проверьте ID и попробуйте еще раз.")
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_question_type")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
+        status = f"❌ Не удалось обновить вопрос с ID {question_id}. Пожалуйста, проверьте ID и попробуйте еще раз."
+    update.message.reply_text(f"{status}\n\nВыберите действие:", reply_markup=_BACK_TO_QUESTION_TYPE_MARKUP)
     return MANAGE_QUESTIONS
 
 def back_to_question_type_handler(update: Update, context: CallbackContext) -> int:
     """Возвращается к списку вопросов для выбранного типа бизнеса."""
-    query = update.callback_query
-    query.answer()
+    answer_callback(update, context)
     business_type = context.user_data.get("selected_business_type")
-    logger.info(f"Возврат к списку вопросов для типа бизнеса '{business_type}'")
+    logger.info("Возврат к списку вопросов для типа бизнеса '%s'", business_type)
     return show_questions_for_type(update, context, business_type)
 
 # --- Управление промптами ---
@@ -903,20 +1328,8 @@ def show_prompt_management(update: Update, context: CallbackContext) -> int:
     """Показывает меню управления промптами."""
     business_types = get_business_types()
     if not business_types:
-        keyboard = [
-            [InlineKeyboardButton("➕ Добавить тип бизнеса", callback_data="add_business_type")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        update.callback_query.edit_message_text(
-            "Нет доступных типов бизнеса. Сначала добавьте тип бизнеса:",
-            reply_markup=reply_markup
-        )
-        logger.info("Нет типов бизнеса для управления промптами")
-        return SELECT_BUSINESS_TYPE
-    keyboard = [[InlineKeyboardButton(btype, callback_data=f"prompt_type:{btype}")] for btype in business_types]
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        return show_no_business_types(update, _NO_TYPES_FROM_MAIN_MARKUP)
+    reply_markup = business_types_markup("prompt_type", tuple(business_types), "back_to_main")
     update.callback_query.edit_message_text("Выберите тип бизнеса для управления промптом:", reply_markup=reply_markup)
     logger.info("Отображено меню управления промптами")
     return MANAGE_PROMPTS
@@ -924,12 +1337,14 @@ def show_prompt_management(update: Update, context: CallbackContext) -> int:
 def prompt_management_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает выбор в меню управления промптами."""
     query = update.callback_query
-    query.answer()
-    logger.info(f"Обработка выбора в меню управления промптами: {query.data}")
-    if query.data == "back_to_main":
-        return show_main_menu(update, context)
-    elif query.data.startswith("prompt_type:"):
-        business_type = query.data.split(":", 1)[1]
+    answer_callback(update, context)
+    logger.info("Обработка выбора в меню управления промптами: %s", query.data)
+    handler = _PROMPT_MANAGEMENT_ROUTES.get(query.data)
+    if handler is not None:
+        return handler(update, context)
+    # Тип бизнеса уже выделен шаблоном обработчика
+    business_type = context.matches[0].group("business_type")
+    if business_type is not None:
         context.user_data["selected_business_type"] = business_type
         return show_prompt_for_type(update, context, business_type)
     return MANAGE_PROMPTS
@@ -937,142 +1352,394 @@ def prompt_management_handler(update: Update, context: CallbackContext) -> int:
 def show_prompt_for_type(update: Update, context: CallbackContext, business_type) -> int:
     """Показывает промпт для указанного типа бизнеса."""
     prompt_text = get_prompt(business_type)
-    message_text = f"📝 Промпт для типа бизнеса '{business_type}':\n\n{prompt_text}"
-    keyboard = [
-        [InlineKeyboardButton("✏️ Редактировать промпт", callback_data="edit_prompt")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_prompt_management")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.callback_query.edit_message_text(message_text, reply_markup=reply_markup)
-    logger.info(f"Отображен промпт для типа бизнеса '{business_type}'")
+    message_text = fit_message(f"📝 Промпт для типа бизнеса '{business_type}':\n\n{prompt_text}")
+    edit_callback_message(update, message_text, _PROMPT_VIEW_MARKUP)
+    logger.info("Отображен промпт для типа бизнеса '%s'", business_type)
     return MANAGE_PROMPTS
 
 def prompt_action_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает действия с промптами."""
     query = update.callback_query
-    query.answer()
-    logger.info(f"Обработка действия с промптом: {query.data}")
-    if query.data == "edit_prompt":
-        business_type = context.user_data.get("selected_business_type")
-        prompt_text = get_prompt(business_type)
-        query.edit_message_text(
-            f"Введите новый текст промпта для типа бизнеса '{business_type}':\n\n"
-            f"Текущий промпт:\n{prompt_text}\n\n"
-            f"Примечание: Используйте '{{}}' для вставки ответов пользователя."
-        )
-        return EDIT_PROMPT
-    elif query.data == "back_to_prompt_management":
-        return show_prompt_management(update, context)
-    return MANAGE_PROMPTS
+    answer_callback(update, context)
+    logger.info("Обработка действия с промптом: %s", query.data)
+    handler = _PROMPT_ACTION_ROUTES.get(query.data)
+    if handler is None:
+        return MANAGE_PROMPTS
+    return handler(update, context)
+
+def request_prompt_edit(update: Update, context: CallbackContext) -> int:
+    """Показывает текущий промпт и запрашивает новый текст."""
+    business_type = context.user_data.get("selected_business_type")
+    header = f"Введите новый текст промпта для типа бизнеса '{business_type}':\n\nТекущий промпт:\n"
+    footer = "\n\nПримечание: Используйте '{}' для вставки ответов пользователя."
+    # Обрезается только текущий промпт, чтобы запрос и примечание остались в сообщении
+    prompt_text = fit_message(get_prompt(business_type), MAX_MESSAGE_LENGTH - utf16_length(header + footer))
+    edit_callback_message(update, header + prompt_text + footer)
+    return EDIT_PROMPT
 
 def edit_prompt_handler(update: Update, context: CallbackContext) -> int:
     """Обрабатывает редактирование промпта."""
     new_prompt = update.message.text.strip()
     business_type = context.user_data.get("selected_business_type")
-    logger.info(f"Попытка обновить промпт для типа бизнеса '{business_type}'")
+    logger.info("Попытка обновить промпт для типа бизнеса '%s'", business_type)
     if update_prompt(business_type, new_prompt):
-        update.message.reply_text(f"✅ Промпт для типа бизнеса '{business_type}' успешно обновлен.")
+        status = f"✅ Промпт для типа бизнеса '{business_type}' успешно обновлен."
     else:
-        update.message.reply_text(f"❌ Не удалось обновить промпт. Пожалуйста, попробуйте еще раз.")
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_prompt_management")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
+        status = "❌ Не удалось обновить промпт. Пожалуйста, попробуйте еще раз."
+    update.message.reply_text(f"{status}\n\nВыберите действие:", reply_markup=_BACK_TO_PROMPT_MGMT_MARKUP)
     return MANAGE_PROMPTS
 
-def back_to_prompt_management_handler(update: Update, context: CallbackContext) -> int:
-    """Возвращается к списку типов бизнеса для управления промптами."""
-    query = update.callback_query
-    query.answer()
-    logger.info("Возврат к меню управления промптами")
-    return show_prompt_management(update, context)
-
 def cancel(update: Update, context: CallbackContext) -> int:
     """Отменяет текущую операцию и завершает диалог."""
     update.message.reply_text("Операция отменена. Диалог завершен.")
     logger.info("Операция отменена пользователем")
     return ConversationHandler.END
 
+_ERR_CONFLICT_TEXT = "Бот запущен в нескольких экземплярах. Остановите лишние и повторите действие."
+_ERR_GENERIC_TEXT = "Произошла ошибка. Попробуйте еще раз или начните заново командой /start."
+
+_BUSY_TEXT = "⏳ Предыдущее действие еще выполняется. Подождите и повторите."
+
+def busy_callback_handler(update: Update, context: CallbackContext) -> None:
+    """Отвечает на нажатие кнопки, пришедшее, пока предыдущий шаг диалога еще выполняется."""
+    update.callback_query.answer(_BUSY_TEXT)
+    logger.info("Нажатие %s отклонено: предыдущий шаг еще выполняется", update.callback_query.data)
+
+def busy_message_handler(update: Update, context: CallbackContext) -> None:
+    """Сообщает, что текст не принят, пока предыдущий шаг диалога еще выполняется."""
+    update.message.reply_text(_BUSY_TEXT)
+    logger.info("Сообщение отклонено: предыдущий шаг еще выполняется")
+
+def error_handler(update: object, context: CallbackContext) -> None:
+    """Логирует необработанные ошибки и сообщает о них администратору."""
+    logger.error("Ошибка при обработке обновления: %s", context.error, exc_info=context.error)
+    # Сетевые ошибки и ошибки опроса приходят без обновления: отвечать некому
+    if update is None:
+        return
+    # У callback-запросов нет update.message, поэтому берем effective_message
+    message = getattr(update, "effective_message", None)
+    if message is None:
+        return
+    text = _ERR_CONFLICT_TEXT if isinstance(context.error, Conflict) else _ERR_GENERIC_TEXT
+    try:
+        message.reply_text(text)
+    except Exception as e:
+        logger.error("Не удалось отправить сообщение об ошибке: %s", e)
+
+# --- Маршрутизация callback-запросов ---
+# Таблицы callback_data -> обработчик: выбор за один поиск в словаре вместо цепочки сравнений
+_MAIN_MENU_ROUTES = {
+    "manage_users": show_user_management,
+    "manage_questions": show_question_management,
+    "manage_prompts": show_prompt_management,
+    "exit": exit_admin_panel,
+}
+
+_USER_MANAGEMENT_ROUTES = {
+    "add_user": show_business_type_selection,
+    "remove_user": request_remove_user,
+    "list_users": show_user_list,
+    "back_to_main": show_main_menu,
+}
+
+_BUSINESS_TYPE_SELECTION_ROUTES = {
+    "add_business_type": request_new_business_type,
+    "back_to_user_management": show_user_management,
+    "back_to_main": show_main_menu,
+}
+
+_USER_LIST_ROUTES = {
+    "back_to_user_management": show_user_management,
+    "select_user_to_edit": show_user_selection,
+}
+
+_EDIT_USER_INFO_ROUTES = {
+    "edit_username": request_username_edit,
+    "edit_comment": request_comment_edit,
+    "back_to_user_select": show_user_selection,
+    "back_to_user_list": show_current_user_list,
+}
+
+_QUESTION_ACTION_ROUTES = {
+    "add_question": request_new_question,
+    "edit_question": request_question_edit,
+    "back_to_question_management": show_question_management,
+}
+
+_PROMPT_MANAGEMENT_ROUTES = {
+    "back_to_main": show_main_menu,
+}
+
+_PROMPT_ACTION_ROUTES = {
+    "edit_prompt": request_prompt_edit,
+    "back_to_prompt_management": show_prompt_management,
+}
+
+def routes_pattern(routes):
+    """Собирает скомпилированный шаблон, совпадающий только с ключами таблицы маршрутизации."""
+    return re.compile(f"^(?:{'|'.join(map(re.escape, routes))})$", re.ASCII)
+
+class TextNotCommand(MessageFilter):
+    """Текстовое сообщение, которое не начинается с команды бота."""
+
+    def filter(self, message):
+        # То же, что Filters.text & ~Filters.command, но одной проверкой без оберток
+        if not message.text:
+            return False
+        entities = message.entities
+        return not (entities and entities[0].type == MessageEntity.BOT_COMMAND and entities[0].offset == 0)
+
+# Один экземпляр фильтра на все состояния, ожидающие ввод текста
+TEXT_NONCMD = TextNotCommand()
+
+# Состояния, в которых ожидается только ввод текста: состояние -> обработчик
+_TEXT_STATES = {
+    ADD_USER: add_user_handler,
+    REMOVE_USER: remove_user_handler,
+    ADD_QUESTION_FOR_TYPE: add_question_for_type_handler,
+    EDIT_QUESTION: update_question_text_handler,
+    EDIT_PROMPT: edit_prompt_handler,
+}
+
+# Шаблоны callback_data для остальных обработчиков компилируются один раз при импорте.
+# Группы незахватывающие: обработчикам нужен только факт совпадения.
+_BACK_TO_USER_MGMT_PATTERN = re.compile(r"^back_to_user_management$", re.ASCII)
+_CANCEL_EDIT_PATTERN = re.compile(r"^cancel_edit$", re.ASCII)
+
+# Каждое состояние с несколькими видами кнопок обслуживается одним обработчиком:
+# шаблон проверяется один раз, а имя сработавшей группы выбирает функцию.
+_MANAGE_USERS_STATE_PATTERN = re.compile(
+    r"^(?:(?P<menu>add_user|remove_user|list_users|back_to_main)"
+    r"|(?P<back>back_to_user_management))$",
+    re.ASCII
+)
+_MANAGE_USERS_STATE_ROUTES = {
+    "menu": user_management_handler,
+    "back": user_list_handler,
+}
+
+_SELECT_BUSINESS_TYPE_STATE_PATTERN = re.compile(
+    r"^(?:(?P<selection>add_business_type|back_to_user_management|back_to_main|select_type:.+)"
+    r"|(?P<new_type>add_user_for_new_type))$",
+    re.ASCII
+)
+_SELECT_BUSINESS_TYPE_STATE_ROUTES = {
+    "selection": business_type_selection_handler,
+    "new_type": add_user_for_new_type_handler,
+}
+
+_LIST_USERS_STATE_PATTERN = re.compile(
+    r"^(?:(?P<list>back_to_user_management|select_user_to_edit)"
+    r"|(?P<back>back_to_user_list)"
+    r"|(?P<page>user_list_page:(?P<page_number>[0-9]+)))$",
+    re.ASCII
+)
+_LIST_USERS_STATE_ROUTES = {
+    "list": user_list_handler,
+    "back": back_to_user_list_handler,
+    "page": user_list_page_handler,
+}
+
+_EDIT_USER_INFO_STATE_PATTERN = re.compile(
+    r"^(?:(?P<user>edit_user:[0-9]+)"
+    r"|(?P<action>edit_username|edit_comment|back_to_user_select|back_to_user_list)"
+    r"|(?P<cancel>cancel_edit))$",
+    re.ASCII
+)
+_EDIT_USER_INFO_STATE_ROUTES = {
+    "user": edit_user_info_handler,
+    "action": edit_user_info_selection_handler,
+    "cancel": cancel_edit_handler,
+}
+
+_QUESTIONS_STATE_PATTERN = re.compile(
+    r"^(?:(?P<management>back_to_main|question_type:(?P<business_type>.+))"
+    r"|(?P<action>add_question|edit_question|back_to_question_management)"
+    r"|(?P<back>back_to_question_type))$",
+    re.ASCII
+)
+_QUESTIONS_STATE_ROUTES = {
+    "management": question_management_handler,
+    "action": question_action_handler,
+    "back": back_to_question_type_handler,
+}
+
+_PROMPTS_STATE_PATTERN = re.compile(
+    r"^(?:(?P<management>back_to_main|prompt_type:(?P<business_type>.+))"
+    r"|(?P<action>edit_prompt|back_to_prompt_management))$",
+    re.ASCII
+)
+_PROMPTS_STATE_ROUTES = {
+    "management": prompt_management_handler,
+    "action": prompt_action_handler,
+}
+
+def group_router(routes):
+    """Создает обработчик, вызывающий функцию по имени сработавшей группы шаблона."""
+    def route(update: Update, context: CallbackContext) -> int:
+        # CallbackQueryHandler уже сохранил результат сопоставления в context.matches
+        return routes[context.matches[0].lastgroup](update, context)
+    return route
+
+class ConversationPicklePersistence(PicklePersistence):
+    """
+    PicklePersistence для диалога с run_async=True: вместо незавершенных Promise,
+    которые нельзя сохранить в pickle, записывает итоговое состояние шага.
+    """
+
+    @staticmethod
+    def resolve_state(state):
+        """
+        Разворачивает пары (прежнее состояние, Promise) до обычного состояния или None.
+        После нескольких асинхронных шагов подряд прежнее состояние само может быть
+        такой парой, поэтому разбор идет до первого завершившегося шага.
+        """
+        while isinstance(state, tuple) and len(state) == 2 and isinstance(state[1], Promise):
+            state, promise = state
+            try:
+                new_state = promise.result(0)
+            except Exception:
+                # Шаг завершился ошибкой: ConversationHandler оставил бы прежнее состояние
+                new_state = None
+            if new_state is not None:
+                return new_state
+        return state
+
+    def flush(self):
+        for conversations in (self.conversations or {}).values():
+            for key, state in list(conversations.items()):
+                new_state = self.resolve_state(state)
+                if new_state is None or new_state == ConversationHandler.END:
+                    del conversations[key]
+                else:
+                    conversations[key] = new_state
+        super().flush()
+
+def refresh_caches():
+    """Перечитывает типы бизнеса и промпты из базы данных в кэш."""
+    get_business_types(refresh=True)
+    get_prompts(refresh=True)
+
+def schedule_cache_refresh(context: CallbackContext) -> None:
+    """Задача JobQueue: обновляет кэши в потоке диспетчера, которому хватит соединения из пула."""
+    context.dispatcher.run_async(refresh_caches)
+
+# Бот обрабатывает только сообщения и нажатия кнопок, остальные типы обновлений Telegram не присылает
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 def main():
     """Основная функция для запуска бота."""
     try:
         init_database()
-        updater = Updater(ADMIN_BOT_TOKEN, use_context=True)
+        # Прогреваем кэши, чтобы первые переходы по меню не ждали базу
+        refresh_caches()
+        api_kwargs = {}
+        if TELEGRAM_API_URL:
+            api_url = TELEGRAM_API_URL.rstrip("/")
+            api_kwargs = {"base_url": f"{api_url}/bot", "base_file_url": f"{api_url}/file/bot"}
+        # HTTP-пул бота: по соединению на каждый поток обработчиков плюс запас
+        # для диспетчера, опроса getUpdates и очереди задач
+        persistence = None
+        if PERSISTENCE_FILE:
+            # Сохраняем на диск только при остановке: запись после каждого нажатия не нужна
+            persistence = ConversationPicklePersistence(
+                PERSISTENCE_FILE, store_chat_data=False, store_bot_data=False, on_flush=True
+            )
+        updater = Updater(
+            ADMIN_BOT_TOKEN,
+            use_context=True,
+            persistence=persistence,
+            workers=BOT_WORKERS,
+            request_kwargs={
+                "con_pool_size": BOT_WORKERS + 4,
+                "connect_timeout": 10,
+                "read_timeout": 20,
+            },
+            **api_kwargs
+        )
         dp = updater.dispatcher
+        logger.info("Потоков обработчиков: %d, соединений в пуле БД: %d", BOT_WORKERS, DB_POOL_MAX)
 
         conv_handler = ConversationHandler(
             entry_points=[CommandHandler("start", start)],
             states={
+                **{state: [MessageHandler(TEXT_NONCMD, handler)] for state, handler in _TEXT_STATES.items()},
                 MAIN_MENU: [
-                    CallbackQueryHandler(main_menu_handler, pattern="^(manage_users|manage_questions|manage_prompts|exit)$")
+                    CallbackQueryHandler(main_menu_handler, pattern=routes_pattern(_MAIN_MENU_ROUTES))
                 ],
                 MANAGE_USERS: [
-                    CallbackQueryHandler(user_management_handler, pattern="^(add_user|remove_user|list_users|back_to_main)$"),
-                    CallbackQueryHandler(user_list_handler, pattern="^back_to_user_management$")
+                    CallbackQueryHandler(group_router(_MANAGE_USERS_STATE_ROUTES), pattern=_MANAGE_USERS_STATE_PATTERN)
                 ],
                 SELECT_BUSINESS_TYPE: [
-                    CallbackQueryHandler(business_type_selection_handler, pattern="^(add_business_type|back_to_user_management|select_type:.+)$"),
-                    CallbackQueryHandler(add_user_for_new_type_handler, pattern="^add_user_for_new_type$"),
-                    MessageHandler(Filters.text & ~Filters.command, add_business_type_handler)
+                    CallbackQueryHandler(group_router(_SELECT_BUSINESS_TYPE_STATE_ROUTES), pattern=_SELECT_BUSINESS_TYPE_STATE_PATTERN)
                 ],
                 ADD_BUSINESS_TYPE: [
-                    MessageHandler(Filters.text & ~Filters.command, add_business_type_handler)
-                ],
-                ADD_USER: [
-                    MessageHandler(Filters.text & ~Filters.command, add_user_handler)
-                ],
-                REMOVE_USER: [
-                    MessageHandler(Filters.text & ~Filters.command, remove_user_handler)
+                    MessageHandler(TEXT_NONCMD, add_business_type_handler),
+                    # Кнопка «Назад» под сообщением об ошибке добавления
+                    CallbackQueryHandler(business_type_selection_handler, pattern=_BACK_TO_USER_MGMT_PATTERN)
                 ],
                 LIST_USERS: [
-                    CallbackQueryHandler(user_list_handler, pattern="^(back_to_user_management|select_user_to_edit)$"),
-                    CallbackQueryHandler(show_user_list, pattern="^back_to_user_list$")
+                    CallbackQueryHandler(group_router(_LIST_USERS_STATE_ROUTES), pattern=_LIST_USERS_STATE_PATTERN)
                 ],
                 MANAGE_QUESTIONS: [
-                    CallbackQueryHandler(question_management_handler, pattern="^(back_to_main|question_type:.+)$"),
-                    CallbackQueryHandler(question_action_handler, pattern="^(add_question|edit_question|back_to_question_management)$"),
-                    CallbackQueryHandler(back_to_question_type_handler, pattern="^back_to_question_type$")
-                ],
-                ADD_QUESTION_FOR_TYPE: [
-                    MessageHandler(Filters.text & ~Filters.command, add_question_for_type_handler)
-                ],
-                EDIT_QUESTION: [
-                    MessageHandler(Filters.text & ~Filters.command, update_question_text_handler)
+                    CallbackQueryHandler(group_router(_QUESTIONS_STATE_ROUTES), pattern=_QUESTIONS_STATE_PATTERN)
                 ],
                 MANAGE_PROMPTS: [
-                    CallbackQueryHandler(prompt_management_handler, pattern="^(back_to_main|prompt_type:.+)$"),
-                    CallbackQueryHandler(prompt_action_handler, pattern="^(edit_prompt|back_to_prompt_management)$"),
-                    CallbackQueryHandler(back_to_prompt_management_handler, pattern="^back_to_prompt_management$")
-                ],
-                EDIT_PROMPT: [
-                    MessageHandler(Filters.text & ~Filters.command, edit_prompt_handler)
+                    CallbackQueryHandler(group_router(_PROMPTS_STATE_ROUTES), pattern=_PROMPTS_STATE_PATTERN)
                 ],
                 EDIT_USER_INFO: [
-                    CallbackQueryHandler(edit_user_info_handler, pattern="^edit_user:[0-9]+$"),
-                    CallbackQueryHandler(edit_user_info_selection_handler, pattern="^(edit_username|edit_comment|back_to_user_select|back_to_user_list)$"),
-                    CallbackQueryHandler(cancel_edit_handler, pattern="^cancel_edit$")
+                    CallbackQueryHandler(group_router(_EDIT_USER_INFO_STATE_ROUTES), pattern=_EDIT_USER_INFO_STATE_PATTERN)
                 ],
                 ADD_USERNAME: [
-                    MessageHandler(Filters.text & ~Filters.command, add_username_handler),
-                    CallbackQueryHandler(cancel_edit_handler, pattern="^cancel_edit$")
+                    MessageHandler(TEXT_NONCMD, add_username_handler),
+                    CallbackQueryHandler(cancel_edit_handler, pattern=_CANCEL_EDIT_PATTERN)
                 ],
                 ADD_COMMENT: [
-                    MessageHandler(Filters.text & ~Filters.command, add_comment_handler),
-                    CallbackQueryHandler(cancel_edit_handler, pattern="^cancel_edit$")
+                    MessageHandler(TEXT_NONCMD, add_comment_handler),
+                    CallbackQueryHandler(cancel_edit_handler, pattern=_CANCEL_EDIT_PATTERN)
+                ],
+                # Обновления чата, пришедшие до завершения его предыдущего шага
+                ConversationHandler.WAITING: [
+                    CallbackQueryHandler(busy_callback_handler),
+                    MessageHandler(TEXT_NONCMD, busy_message_handler)
                 ],
             },
-            fallbacks=[CommandHandler("cancel", cancel)]
+            fallbacks=[CommandHandler("cancel", cancel)],
+            name="admin_panel",
+            persistent=persistence is not None,
+            # Обработчики блокируются на запросах к БД и Telegram, поэтому выполняем их
+            # в пуле потоков диспетчера, и разные чаты обслуживаются параллельно.
+            # Пока шаг чата выполняется, его новые обновления не ставятся в очередь, а
+            # попадают в состояние WAITING: обработчики оттуда отвечают «подождите»
+            # и возвращают None, поэтому состояние диалога не меняется, а само
+            # нажатие или сообщение не обрабатывается и его нужно повторить.
+            run_async=True
         )
 
         dp.add_handler(conv_handler)
+        dp.add_error_handler(error_handler)
+        updater.job_queue.run_repeating(schedule_cache_refresh, interval=CACHE_REFRESH_INTERVAL, first=CACHE_REFRESH_INTERVAL)
         
-        logger.info("Бот запущен")
-        updater.start_polling()
+        if WEBHOOK_URL:
+            # Telegram сам доставляет обновления, опрос getUpdates не нужен.
+            # Токен в пути вебхука не дает подделать обновления: без него запрос не дойдет до диспетчера.
+            updater.start_webhook(
+                listen="0.0.0.0",
+                port=WEBHOOK_PORT,
+                url_path=ADMIN_BOT_TOKEN,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{ADMIN_BOT_TOKEN}",
+                allowed_updates=ALLOWED_UPDATES,
+                # Одновременных запросов от Telegram не больше, чем потоков обработчиков
+                max_connections=BOT_WORKERS
+            )
+            logger.info("Бот запущен в режиме вебхука")
+        else:
+            # Длинный опрос: сервер держит запрос до 20 секунд, пока не появятся обновления
+            updater.start_polling(poll_interval=0, timeout=20, allowed_updates=ALLOWED_UPDATES)
+            logger.info("Бот запущен")
         updater.idle()
     except Exception as e:
-        logger.error(f"Ошибка при запуске бота: {e}")
-    finally:
-        db_pool.closeall()
-        logger.info("Пул соединений закрыт")
+        logger.error("Ошибка при запуске бота: %s", e)
 
 if __name__ == "__main__":
     main()
@@ -93,7 +93,7 @@ def get_questions(business_type):
     ORDER BY question_order
     """, (business_type,))
     
-    questions = [row[0] for row in cur.fetchall()]
+    questions = [row[0] for row in cur]
     
     cur.close()
     conn.close()
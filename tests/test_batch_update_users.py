@@ -0,0 +1,66 @@
+import os
+import unittest
+
+import admin_bot
+import db
+
+# Запрос проверяется на настоящей базе: задайте TEST_DB_HOST (и при необходимости
+# TEST_DB_NAME, TEST_DB_USER, TEST_DB_PASSWORD) с отдельной тестовой базой
+TEST_DB_HOST = os.getenv("TEST_DB_HOST")
+
+TEST_USER_IDS = (-1001, -1002)
+
+
+@unittest.skipUnless(TEST_DB_HOST, "TEST_DB_HOST не задан")
+class BatchUpdateUsersTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        settings = {
+            "DB_HOST": TEST_DB_HOST,
+            "DB_NAME": os.getenv("TEST_DB_NAME", "postgres"),
+            "DB_USER": os.getenv("TEST_DB_USER", "postgres"),
+            "DB_PASSWORD": os.getenv("TEST_DB_PASSWORD", ""),
+        }
+        for module in (admin_bot, db):
+            for name, value in settings.items():
+                setattr(module, name, value)
+        admin_bot._db_pool = None
+        db.create_tables()
+        admin_bot.init_database()
+
+    def setUp(self):
+        with admin_bot.db_cursor(commit=True) as cur:
+            cur.execute("DELETE FROM users WHERE telegram_id = ANY(%s)", (list(TEST_USER_IDS),))
+            cur.execute(
+                "INSERT INTO users (telegram_id, business_type, username, comment) VALUES (%s, 'T', 'old', 'old'), (%s, 'T', NULL, NULL)",
+                TEST_USER_IDS
+            )
+
+    def tearDown(self):
+        with admin_bot.db_cursor(commit=True) as cur:
+            cur.execute("DELETE FROM users WHERE telegram_id = ANY(%s)", (list(TEST_USER_IDS),))
+
+    def users(self):
+        with admin_bot.db_cursor() as cur:
+            cur.execute(
+                "SELECT telegram_id, username, comment FROM users WHERE telegram_id = ANY(%s) ORDER BY telegram_id DESC",
+                (list(TEST_USER_IDS),)
+            )
+            return cur.fetchall()
+
+    def test_updates_existing_users_and_keeps_fields_passed_as_none(self):
+        changes = [(-1001, None, "new"), (-1002, "name", None), (-1003, "missing", "missing")]
+        self.assertEqual(admin_bot.batch_update_users(changes), 2)
+        self.assertEqual(self.users(), [(-1001, "old", "new"), (-1002, "name", None)])
+
+    def test_counts_rows_across_execute_values_pages(self):
+        # Больше page_size=100: execute_values отправляет несколько команд
+        changes = [(-1001, "a", None)] + [(-2000 - i, "x", None) for i in range(150)] + [(-1002, "b", None)]
+        self.assertEqual(admin_bot.batch_update_users(changes), 2)
+
+    def test_empty_batch_does_nothing(self):
+        self.assertEqual(admin_bot.batch_update_users([]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+from telegram.ext.utils.promise import Promise
+
+from admin_bot import MAIN_MENU, MANAGE_USERS, ConversationPicklePersistence
+
+
+def failed_promise():
+    """Promise шага, завершившегося исключением."""
+    promise = Promise(lambda: 1 / 0, (), {})
+    promise.run()
+    return promise
+
+
+def finished_promise(state):
+    """Promise шага, вернувшего новое состояние."""
+    promise = Promise(lambda: state, (), {})
+    promise.run()
+    return promise
+
+
+def pending_promise():
+    """Promise шага, который еще не начал выполняться."""
+    return Promise(lambda: MANAGE_USERS, (), {})
+
+
+class ConversationPicklePersistenceTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.filename = os.path.join(tmp.name, "persistence.pickle")
+        self.persistence = ConversationPicklePersistence(filename=self.filename)
+
+    def flush(self, conversations):
+        self.persistence.conversations = {"admin_panel": conversations}
+        self.persistence.flush()
+        with open(self.filename, "rb") as f:
+            return pickle.load(f)["conversations"]["admin_panel"]
+
+    def test_nested_failed_and_pending_steps_fall_back_to_last_plain_state(self):
+        # Второй шаг упал, первый еще не выполнен: остается состояние до обоих шагов
+        state = ((MAIN_MENU, pending_promise()), failed_promise())
+        self.assertEqual(self.flush({(1, 1): state}), {(1, 1): MAIN_MENU})
+
+    def test_nested_state_uses_latest_finished_step(self):
+        state = ((MAIN_MENU, finished_promise(MANAGE_USERS)), failed_promise())
+        self.assertEqual(self.flush({(1, 1): state}), {(1, 1): MANAGE_USERS})
+
+    def test_key_is_dropped_when_nothing_resolves(self):
+        state = ((None, pending_promise()), failed_promise())
+        self.assertEqual(self.flush({(1, 1): state, (2, 2): MAIN_MENU}), {(2, 2): MAIN_MENU})
+
+
+if __name__ == "__main__":
+    unittest.main()